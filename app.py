@@ -3,17 +3,1099 @@ Flask backend for the tiktoken visualizer web application.
 Provides API endpoints to handle tiktoken functionality.
 """
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
 from flask_cors import CORS
 import tiktoken
 import os
 import socket
+import codecs
+import struct
+import hashlib
+import inspect
+import json
+import logging
+import marshal
+import sqlite3
+import tempfile
+import threading
+import time
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import numpy as np
-from sklearn.decomposition import PCA
-from sklearn.preprocessing import StandardScaler
+from sklearn.decomposition import IncrementalPCA
 
 app = Flask(__name__, static_folder='static')
 CORS(app)  # Enable CORS for all routes
+logger = logging.getLogger(__name__)
+
+# Shared worker pool for batch tokenization. CoreBPE releases the GIL while it
+# encodes, so the documents of a batch are tokenized in parallel; sharing one
+# bounded pool keeps concurrent batch requests from oversubscribing the CPU.
+ENCODE_WORKERS = int(os.environ.get('ENCODE_WORKERS', os.cpu_count() or 4))
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 1024))
+encode_pool = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix='encode')
+
+
+def _encode_options(allow_special, special_tokens):
+    """Keyword arguments of Encoding.encode for the special token options of the encode endpoints"""
+    if allow_special and special_tokens:
+        # Allow specific special tokens
+        return {"allowed_special": set(special_tokens)}
+    # Disable all special token checks, treat them as normal text
+    return {"disallowed_special": ()}
+
+
+def _encode_with_options(encoding, text, allow_special, special_tokens):
+    """Encode text honouring the special token options of the encode endpoints"""
+    return encoding.encode(text, **_encode_options(allow_special, special_tokens))
+
+
+def _encode_to_array(encoding, text, allow_special, special_tokens):
+    """Encode text into a uint32 array, skipping the Python list where tiktoken supports it"""
+    options = _encode_options(allow_special, special_tokens)
+    if hasattr(encoding, 'encode_to_numpy'):
+        return encoding.encode_to_numpy(text, **options)
+    return np.asarray(encoding.encode(text, **options), dtype=np.uint32)
+
+
+def _fix_surrogates(text):
+    """Same fixup as Encoding.encode for text with lone surrogates, which the native core rejects"""
+    return text.encode("utf-16", "surrogatepass").decode("utf-16", "replace")
+
+
+def _native_allowed_special(encoding, texts, allow_special, special_tokens):
+    """Allowed special tokens to pass to native CoreBPE methods, checking texts like Encoding.encode does"""
+    allowed_special = _encode_options(allow_special, special_tokens).get("allowed_special", set())
+    if allowed_special:
+        # The other special tokens may not appear in the text
+        disallowed_special = encoding.special_tokens_set - allowed_special
+        for text in texts:
+            for token in disallowed_special:
+                if token in text:
+                    raise ValueError(f"Encountered text corresponding to disallowed special token {token!r}")
+    return allowed_special
+
+
+def _count_with_options(encoding, text, allow_special, special_tokens):
+    """Count the tokens of text, without building the token list where the native core supports it"""
+    count_tokens = getattr(encoding._core_bpe, 'count_tokens', None)
+    if count_tokens is None:
+        return len(_encode_with_options(encoding, text, allow_special, special_tokens))
+    
+    allowed_special = _native_allowed_special(encoding, [text], allow_special, special_tokens)
+    try:
+        return count_tokens(text, allowed_special)
+    except UnicodeEncodeError:
+        return count_tokens(_fix_surrogates(text), allowed_special)
+
+
+def _encode_truncated(encoding, text, allow_special, special_tokens, max_tokens):
+    """
+    Encode at most max_tokens tokens of text, returning them with the number of characters of
+    text they cover. The native core stops encoding once the limit is reached.
+    """
+    encode_with_limit = getattr(encoding._core_bpe, 'encode_with_limit', None)
+    if encode_with_limit is None:
+        tokens = _encode_with_options(encoding, text, allow_special, special_tokens)
+        if len(tokens) <= max_tokens:
+            return tokens, len(text)
+        tokens = tokens[:max_tokens]
+        # A last token that ends inside a character doesn't cover it
+        return tokens, len(encoding.decode_bytes(tokens).decode('utf-8', errors='ignore'))
+    
+    allowed_special = _native_allowed_special(encoding, [text], allow_special, special_tokens)
+    try:
+        return encode_with_limit(text, allowed_special, max_tokens)
+    except UnicodeEncodeError:
+        return encode_with_limit(_fix_surrogates(text), allowed_special, max_tokens)
+
+
+def _pool_slices(texts):
+    """
+    Split texts into contiguous slices to run on encode_pool, a few per worker so that a slice
+    of long texts doesn't leave the other workers idle
+    """
+    size = max(1, -(-len(texts) // (4 * ENCODE_WORKERS)))
+    return [texts[start:start + size] for start in range(0, len(texts), size)]
+
+
+def _encode_batch_with_options(encoding, texts, allow_special, special_tokens):
+    """Encode a list of texts on encode_pool, a native call per slice where the core supports it"""
+    encode_batch = getattr(encoding._core_bpe, 'encode_batch', None)
+    if encode_batch is None:
+        return list(encode_pool.map(
+            lambda text: _encode_with_options(encoding, text, allow_special, special_tokens),
+            texts,
+        ))
+    
+    # The native batch encode releases the GIL once per slice and returns all its tokens in one
+    # u32 buffer with u64 offsets per text. It runs on a single thread of the shared pool, so
+    # that concurrent requests don't each start threads of their own.
+    allowed_special = _native_allowed_special(encoding, texts, allow_special, special_tokens)
+    
+    def encode_slice(batch):
+        try:
+            tokens, offsets = encode_batch(batch, allowed_special, 1)
+        except UnicodeEncodeError:
+            tokens, offsets = encode_batch([_fix_surrogates(text) for text in batch], allowed_special, 1)
+        tokens = np.frombuffer(tokens, dtype=np.uint32).tolist()
+        offsets = np.frombuffer(offsets, dtype=np.uint64).tolist()
+        return [tokens[start:end] for start, end in zip(offsets, offsets[1:])]
+    
+    return [tokens for batch_tokens in encode_pool.map(encode_slice, _pool_slices(texts)) for tokens in batch_tokens]
+
+
+def _chunk_token_ranges(encoding, tokens, max_tokens, overlap):
+    """
+    Split tokens into chunks of at most max_tokens tokens, each starting overlap tokens
+    before the end of the previous one. Returns (token_start, token_end, char_start,
+    char_end) per chunk; a character split between two tokens belongs to both chunks.
+    """
+    table = _get_token_table(encoding)
+    char_counts = table["char_counts"]
+    starts_mid_char = table["starts_mid_char"]
+    
+    char_offsets = [0]
+    for token in tokens:
+        char_offsets.append(char_offsets[-1] + char_counts[token])
+    
+    chunks = []
+    start = 0
+    while start < len(tokens):
+        end = min(start + max_tokens, len(tokens))
+        chunks.append((start, end, char_offsets[start] - starts_mid_char[tokens[start]], char_offsets[end]))
+        if end == len(tokens):
+            break
+        start = end - overlap
+    return chunks
+
+
+def _chunk_batch_with_options(encoding, texts, allow_special, special_tokens, max_tokens, overlap):
+    """
+    Encode and chunk a list of texts, returning (tokens, chunks) per text. The native core
+    does it without decoding the chunks back to text.
+    """
+    chunk_batch = getattr(encoding._core_bpe, 'chunk_batch', None)
+    if chunk_batch is None:
+        batch_tokens = _encode_batch_with_options(encoding, texts, allow_special, special_tokens)
+        return [(tokens, _chunk_token_ranges(encoding, tokens, max_tokens, overlap)) for tokens in batch_tokens]
+    
+    # One single-threaded native call per slice on the shared pool, like _encode_batch_with_options
+    allowed_special = _native_allowed_special(encoding, texts, allow_special, special_tokens)
+    
+    def chunk_slice(batch):
+        try:
+            return chunk_batch(batch, allowed_special, max_tokens, overlap, 1)
+        except UnicodeEncodeError:
+            return chunk_batch([_fix_surrogates(text) for text in batch], allowed_special, max_tokens, overlap, 1)
+    
+    return [result for results in encode_pool.map(chunk_slice, _pool_slices(texts)) for result in results]
+
+
+def _chunk_sizes(data):
+    """Validated max_tokens and overlap of a chunk request, or None if they are invalid"""
+    max_tokens = data.get('max_tokens')
+    overlap = data.get('overlap', 0)
+    if type(max_tokens) is not int or type(overlap) is not int or not 0 <= overlap < max_tokens:
+        return None
+    return max_tokens, overlap
+
+
+def _chunk_result(text, tokens, chunks):
+    return {
+        "token_count": len(tokens),
+        "chunks": [
+            {
+                "tokens": tokens[token_start:token_end],
+                "token_start": token_start,
+                "token_end": token_end,
+                "char_start": char_start,
+                "char_end": char_end,
+                "text": text[char_start:char_end],
+            }
+            for token_start, token_end, char_start, char_end in chunks
+        ],
+    }
+
+
+# Binary token wire formats, negotiated with the Accept header of /api/encode and the
+# Content-Type of /api/decode request bodies. Both start with an 8-byte header: a
+# 4-byte magic and the token count as a little-endian uint32. The header is followed
+# by the tokens as little-endian uint32 (raw) or as LEB128 varints (varint).
+TOKENS_RAW_MIMETYPE = 'application/octet-stream'
+TOKENS_VARINT_MIMETYPE = 'application/x-tiktoken-varint'
+_TOKENS_MAGIC = {TOKENS_RAW_MIMETYPE: b"TKU4", TOKENS_VARINT_MIMETYPE: b"TKV1"}
+_TOKENS_HEADER = struct.Struct('<4sI')
+_VARINT_MAX_BYTES = 5  # ceil(32 / 7)
+
+
+def _negotiate_token_format():
+    """Return the binary token format the client asked for, or None for JSON"""
+    best = request.accept_mimetypes.best_match(
+        ['application/json', TOKENS_RAW_MIMETYPE, TOKENS_VARINT_MIMETYPE]
+    )
+    return best if best in _TOKENS_MAGIC else None
+
+
+def _pack_tokens(tokens, token_format):
+    """Serialize tokens into one of the binary token formats"""
+    values = np.asarray(tokens, dtype=np.uint32)
+    header = _TOKENS_HEADER.pack(_TOKENS_MAGIC[token_format], len(values))
+    if token_format == TOKENS_RAW_MIMETYPE:
+        return header + values.astype('<u4', copy=False).tobytes()
+    
+    # Split every value into 7-bit groups, least significant first, and keep as many
+    # groups as the value needs; all but the last group of a value get the high bit
+    values = values.astype(np.uint64)
+    n_groups = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 7 * _VARINT_MAX_BYTES, 7):
+        n_groups += values >= (1 << shift)
+    shifts = np.arange(_VARINT_MAX_BYTES, dtype=np.uint64) * 7
+    groups = ((values[:, None] >> shifts) & 0x7F).astype(np.uint8)
+    group_index = np.arange(_VARINT_MAX_BYTES)
+    groups[group_index < n_groups[:, None] - 1] |= 0x80
+    return header + groups[group_index < n_groups[:, None]].tobytes()
+
+
+def _unpack_tokens(data, token_format):
+    """Parse a binary token payload into a uint32 array, raising ValueError if it is malformed"""
+    if len(data) < _TOKENS_HEADER.size:
+        raise ValueError("Token payload is too short")
+    magic, count = _TOKENS_HEADER.unpack_from(data)
+    if magic != _TOKENS_MAGIC[token_format]:
+        raise ValueError("Token payload has an invalid header")
+    body = np.frombuffer(data, dtype=np.uint8, offset=_TOKENS_HEADER.size)
+    
+    if token_format == TOKENS_RAW_MIMETYPE:
+        if len(body) != 4 * count:
+            raise ValueError(f"Expected {count} tokens, got {len(body) // 4}")
+        return body.view('<u4').astype(np.uint32)
+    
+    # The last byte of every varint is the one without the high bit set
+    ends = np.flatnonzero(body < 0x80)
+    if len(ends) != count or (len(body) and body[-1] >= 0x80):
+        raise ValueError(f"Expected {count} tokens in the varint payload")
+    if count == 0:
+        return np.zeros(0, dtype=np.uint32)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    lengths = ends - starts + 1
+    if np.any(lengths > _VARINT_MAX_BYTES):
+        raise ValueError("Varint token is out of range")
+    group_shifts = (np.arange(len(body)) - np.repeat(starts, lengths)) * 7
+    group_values = (body & 0x7F).astype(np.uint64) << group_shifts.astype(np.uint64)
+    values = np.zeros(count, dtype=np.uint64)
+    np.add.at(values, np.repeat(np.arange(count), lengths), group_values)
+    if np.any(values > 0xFFFFFFFF):
+        raise ValueError("Varint token is out of range")
+    return values.astype(np.uint32)
+
+class _ResultCache:
+    """
+    Thread-safe LRU cache for endpoint results. It is bounded by the approximate total
+    size of the cached values in bytes, entries expire after ttl seconds, and it
+    counts hits, misses and evictions.
+    """
+    
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+        self._lock = threading.Lock()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                self._size -= entry[1]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+    
+    def peek(self, key):
+        """Return the cached value like get, but without counting a hit or miss or refreshing the entry"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                return None
+            return entry[2]
+    
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[key] = (time.monotonic() + self.ttl, size, value)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+# Cache of /api/encode and /api/decode results, keyed by a digest of the input
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+RESULT_CACHE_TTL = float(os.environ.get('RESULT_CACHE_TTL', 3600))
+result_cache = _ResultCache(RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL)
+
+# Rough per-token memory cost of a cached encode result: a list slot for the token,
+# its text and its offset, plus the int objects of the token and the offset. The
+# token texts themselves are shared with the token table.
+_ENCODED_TOKEN_SIZE = 3 * 8 + 2 * 28
+_CACHE_ENTRY_OVERHEAD = 256
+
+
+def _text_digest(text):
+    # surrogatepass: JSON bodies may contain lone surrogates
+    return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+
+def _encode_cache_key(encoding_name, text, allow_special, special_tokens):
+    allowed_special = frozenset(special_tokens) if allow_special and special_tokens else frozenset()
+    return ("encode", encoding_name, allowed_special, _text_digest(text))
+
+
+def _decode_cache_key(encoding_name, tokens):
+    token_bytes = array('q', tokens).tobytes()
+    return ("decode", encoding_name, hashlib.blake2b(token_bytes, digest_size=16).digest())
+
+
+class _SharedEncodeCache:
+    """
+    Encode results cached in a SQLite database in WAL mode, shared by all worker
+    processes on a host, so that a text tokenized by one worker is a hit for every
+    other worker. Entries are keyed by a content hash and hold the tokens as a packed
+    uint32 array. When the total size of the entries exceeds max_bytes, the least
+    recently used ones are evicted.
+    """
+    
+    # Only refresh the access time of a hit if it is older than this, to keep hits read-only
+    ACCESS_RESOLUTION = 60
+    EVICTION_BATCH = 64
+    
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        conn = self._connection()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS encode_cache (
+                key BLOB PRIMARY KEY,
+                tokens BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                accessed INTEGER NOT NULL
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS encode_cache_accessed ON encode_cache (accessed);
+            CREATE TABLE IF NOT EXISTS encode_cache_size (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                bytes INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO encode_cache_size VALUES (0, 0);
+            CREATE TRIGGER IF NOT EXISTS encode_cache_insert AFTER INSERT ON encode_cache BEGIN
+                UPDATE encode_cache_size SET bytes = bytes + NEW.size WHERE id = 0;
+            END;
+            CREATE TRIGGER IF NOT EXISTS encode_cache_delete AFTER DELETE ON encode_cache BEGIN
+                UPDATE encode_cache_size SET bytes = bytes - OLD.size WHERE id = 0;
+            END;
+        """)
+    
+    def _connection(self):
+        # One connection per thread and process; a connection inherited across fork()
+        # must not be used by the child
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            local.conn = conn
+            local.pid = os.getpid()
+        return local.conn
+    
+    def get(self, key):
+        try:
+            conn = self._connection()
+            row = conn.execute(
+                'SELECT tokens, accessed FROM encode_cache WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            now = int(time.time())
+            if now - row[1] > self.ACCESS_RESOLUTION:
+                conn.execute('UPDATE encode_cache SET accessed = ? WHERE key = ?', (now, key))
+        except sqlite3.Error as e:
+            logger.warning("Shared cache lookup failed: %s", e)
+            return None
+        tokens = array('I')
+        tokens.frombytes(row[0])
+        return tokens.tolist()
+    
+    def put(self, key, tokens):
+        data = array('I', tokens).tobytes()
+        size = len(data) + len(key) + _CACHE_ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        try:
+            conn = self._connection()
+            conn.execute(
+                'INSERT INTO encode_cache VALUES (?, ?, ?, ?) ON CONFLICT (key) DO NOTHING',
+                (key, data, size, int(time.time())),
+            )
+            total = conn.execute('SELECT bytes FROM encode_cache_size WHERE id = 0').fetchone()[0]
+            while total > self.max_bytes:
+                conn.execute(
+                    'DELETE FROM encode_cache WHERE key IN '
+                    '(SELECT key FROM encode_cache ORDER BY accessed LIMIT ?)',
+                    (self.EVICTION_BATCH,),
+                )
+                total = conn.execute('SELECT bytes FROM encode_cache_size WHERE id = 0').fetchone()[0]
+        except sqlite3.Error as e:
+            logger.warning("Shared cache insert failed: %s", e)
+    
+    def stats(self):
+        try:
+            conn = self._connection()
+            entries = conn.execute('SELECT COUNT(*) FROM encode_cache').fetchone()[0]
+            total = conn.execute('SELECT bytes FROM encode_cache_size WHERE id = 0').fetchone()[0]
+        except sqlite3.Error as e:
+            return {"error": str(e)}
+        return {"path": self.path, "entries": entries, "bytes": total, "max_bytes": self.max_bytes}
+
+
+# Optional cross-worker cache of /api/encode results, enabled by setting SHARED_CACHE_PATH
+SHARED_CACHE_PATH = os.environ.get('SHARED_CACHE_PATH')
+SHARED_CACHE_MAX_BYTES = int(os.environ.get('SHARED_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+shared_cache = _SharedEncodeCache(SHARED_CACHE_PATH, SHARED_CACHE_MAX_BYTES) if SHARED_CACHE_PATH else None
+
+
+def _shared_cache_key(cache_key):
+    """Content hash of an encode cache key, stable across processes"""
+    _, encoding_name, allowed_special, text_digest = cache_key
+    h = hashlib.blake2b(digest_size=16)
+    h.update(encoding_name.encode('utf-8') + b"\0")
+    h.update("\x1f".join(sorted(allowed_special)).encode('utf-8', 'surrogatepass') + b"\0")
+    h.update(text_digest)
+    return h.digest()
+
+
+# Streaming tokenization reads the request body in chunks of this many bytes
+STREAM_READ_SIZE = 64 * 1024
+
+
+def _is_ascii_letter(c):
+    return 'a' <= c <= 'z' or 'A' <= c <= 'Z'
+
+
+def _stable_split_point(text, start=1):
+    """
+    Return the last index in [start, len(text)) at which text can be cut without
+    changing its tokenization, or None if there is none.
+    
+    For every pre-tokenizer pattern in tiktoken_ext/openai_public.py, no regex piece
+    spans such a position, whatever text follows it:
+    
+    - a space preceded by a non-whitespace character
+    - a line break that doesn't follow whitespace, followed by a character other than
+      whitespace or "/" (after whitespace, the \\s++$ of the r50k pattern would make the
+      whitespace and the line break one piece at the end of the first part)
+    - a transition between an ASCII letter and an ASCII digit, in either direction
+    
+    None of the special tokens contain such a position either.
+    """
+    for i in range(len(text) - 1, max(start, 1) - 1, -1):
+        before = text[i - 1]
+        after = text[i]
+        if after == ' ':
+            if not before.isspace():
+                return i
+        elif before == '\n' or before == '\r':
+            if not after.isspace() and after != '/' and not (i >= 2 and text[i - 2].isspace()):
+                return i
+        elif ('0' <= before <= '9' and _is_ascii_letter(after)) or (
+            _is_ascii_letter(before) and '0' <= after <= '9'
+        ):
+            return i
+    return None
+
+
+# Per-encoding token tables, built once and indexed by token id. They replace a
+# decode() round trip into Rust for every token of a response.
+_token_tables = {}
+_token_tables_lock = threading.Lock()
+
+
+def _get_token_table(encoding):
+    """
+    Return the token table of an encoding as a dict of lists indexed by token id:
+    the raw token bytes, their display text, the number of characters each token
+    starts and whether the token starts in the middle of a UTF-8 character.
+    Unused token ids hold None.
+    """
+    table = _token_tables.get(encoding.name)
+    if table is not None:
+        return table
+    
+    with _token_tables_lock:
+        table = _token_tables.get(encoding.name)
+        if table is None:
+            token_bytes = [None] * (encoding.max_token_value + 1)
+            for token_value, token in encoding._mergeable_ranks.items():
+                token_bytes[token] = token_value
+            for token_text, token in encoding._special_tokens.items():
+                token_bytes[token] = token_text.encode('utf-8')
+            
+            table = {
+                "bytes": token_bytes,
+                "texts": [b.decode('utf-8', errors='replace') if b is not None else None for b in token_bytes],
+                # UTF-8 continuation bytes (0b10xxxxxx) never start a character
+                "char_counts": [sum(1 for c in b if not 0x80 <= c < 0xC0) if b else 0 for b in token_bytes],
+                "starts_mid_char": [bool(b) and 0x80 <= b[0] < 0xC0 for b in token_bytes],
+            }
+            _token_tables[encoding.name] = table
+    return table
+
+
+def _decode_with_offsets(encoding, tokens):
+    """Decode tokens into text and the character offset of each token, natively where supported"""
+    decode_with_offsets = getattr(encoding._core_bpe, 'decode_with_offsets', None)
+    if decode_with_offsets is None:
+        return encoding.decode_with_offsets(tokens)
+    return decode_with_offsets(tokens)
+
+
+def _decode_token_spans(encoding, tokens):
+    """
+    Decode tokens into their bytes, display texts and character offsets in a single pass.
+    
+    The offset of a token is the index of the first character of the decoded text it
+    contributes to; a token starting in the middle of a character points at that
+    character, as in tiktoken's Encoding.decode_with_offsets.
+    """
+    table = _get_token_table(encoding)
+    all_bytes = table["bytes"]
+    all_texts = table["texts"]
+    char_counts = table["char_counts"]
+    starts_mid_char = table["starts_mid_char"]
+    
+    decode_with_offsets = getattr(encoding._core_bpe, 'decode_with_offsets', None)
+    if decode_with_offsets is not None:
+        # The native core computes the offsets in one pass over the token bytes. It rejects
+        # unknown tokens and invalid UTF-8, which the loop below handles.
+        try:
+            _, token_offsets = decode_with_offsets(tokens)
+        except (KeyError, ValueError):
+            pass
+        else:
+            return [all_bytes[token] for token in tokens], [all_texts[token] for token in tokens], token_offsets
+    
+    token_bytes = []
+    token_texts = []
+    token_offsets = []
+    text_len = 0
+    for token in tokens:
+        if not 0 <= token < len(all_bytes) or all_bytes[token] is None:
+            token_bytes.append(b"")
+            token_texts.append("[SPECIAL]")
+            token_offsets.append(text_len)
+            continue
+        token_bytes.append(all_bytes[token])
+        token_texts.append(all_texts[token])
+        token_offsets.append(max(0, text_len - 1) if starts_mid_char[token] else text_len)
+        text_len += char_counts[token]
+    
+    return token_bytes, token_texts, token_offsets
+
+
+# Per-encoding feature matrices for the vector visualization. They are computed once
+# for the whole vocabulary and cached on disk as .npy files, which are memory-mapped
+# so that every worker process shares the same pages.
+FEATURE_VERSION = 1
+VECTOR_CACHE_DIR = os.environ.get(
+    'VECTOR_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'tiktoken-visualizer')
+)
+_feature_matrices = {}
+_feature_matrices_lock = threading.Lock()
+
+# The projection into the visualization space is fitted once over the whole
+# vocabulary, so coordinates are stable and comparable across requests.
+PROJECTION_DIMENSIONS = 3
+PROJECTION_BATCH_SIZE = 16384
+_projections = {}
+_projections_lock = threading.Lock()
+
+
+def _segment_sums(values, starts, ends):
+    """Sum values over the [start, end) segments of a flat per-character array"""
+    cumsum = np.concatenate(([0], np.cumsum(values, dtype=np.int64)))
+    return cumsum[ends] - cumsum[starts]
+
+
+def _compute_vocab_features(encoding):
+    """
+    Compute the visualization features of every token of an encoding, vectorized over
+    the characters of the whole vocabulary. Row i holds the features of token i:
+    
+    - text length / 10
+    - ratio of alphabetic, digit, whitespace and punctuation characters
+    - mean and standard deviation of the code points (scaled by 255 and 128)
+    - flags: single character, word, number, special (not alphanumeric)
+    - first and last code point / 255
+    - flags: has an uppercase character, all uppercase, starts uppercase
+    - token id / max token id * 0.1
+    
+    Token ids without a token get an empty text. The columns are standardized over
+    the vocabulary.
+    """
+    texts = [text or "" for text in _get_token_table(encoding)["texts"]]
+    n_tokens = len(texts)
+    
+    lengths = np.fromiter((len(text) for text in texts), dtype=np.int64, count=n_tokens)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    nonempty = lengths > 0
+    safe_lengths = np.maximum(lengths, 1)
+    
+    codepoints = np.frombuffer("".join(texts).encode("utf-32-le"), dtype=np.uint32)
+    chars = codepoints.view("<U1")
+    is_alpha = np.char.isalpha(chars)
+    is_digit = np.char.isdigit(chars)
+    is_space = np.char.isspace(chars)
+    is_alnum = np.char.isalnum(chars)
+    is_upper = np.char.isupper(chars)
+    is_lower = np.char.islower(chars)
+    # Titlecase letters like "ǅ" are cased but neither upper nor lower case
+    is_title = np.char.istitle(chars) & ~is_upper
+    
+    n_alpha = _segment_sums(is_alpha, starts, ends)
+    n_digit = _segment_sums(is_digit, starts, ends)
+    n_space = _segment_sums(is_space, starts, ends)
+    n_alnum = _segment_sums(is_alnum, starts, ends)
+    n_punct = _segment_sums(~is_alnum & ~is_space, starts, ends)
+    n_upper = _segment_sums(is_upper, starts, ends)
+    n_lower = _segment_sums(is_lower, starts, ends)
+    n_title = _segment_sums(is_title, starts, ends)
+    
+    ords = codepoints.astype(np.float64)
+    ord_sum = np.concatenate(([0.0], np.cumsum(ords)))
+    ord_sq_sum = np.concatenate(([0.0], np.cumsum(ords * ords)))
+    ord_mean = (ord_sum[ends] - ord_sum[starts]) / safe_lengths
+    ord_var = (ord_sq_sum[ends] - ord_sq_sum[starts]) / safe_lengths - ord_mean ** 2
+    ord_std = np.where(lengths > 1, np.sqrt(np.maximum(ord_var, 0.0)), 0.0)
+    
+    # A trailing sentinel keeps the first/last character lookups of empty texts in bounds
+    padded_ords = np.append(ords, 0.0)
+    padded_upper = np.append(is_upper, False)
+    first_ord = np.where(nonempty, padded_ords[starts], 0.0)
+    last_ord = np.where(nonempty, padded_ords[ends - 1], 0.0)
+    first_upper = nonempty & padded_upper[starts]
+    
+    all_alpha = nonempty & (n_alpha == lengths)
+    all_digit = nonempty & (n_digit == lengths)
+    all_alnum = nonempty & (n_alnum == lengths)
+    
+    features = np.column_stack([
+        lengths / 10.0,
+        n_alpha / safe_lengths,
+        n_digit / safe_lengths,
+        n_space / safe_lengths,
+        n_punct / safe_lengths,
+        ord_mean / 255.0,
+        ord_std / 128.0,
+        lengths == 1,
+        all_alpha & (lengths > 1),
+        all_digit,
+        nonempty & ~all_alnum,
+        first_ord / 255.0,
+        last_ord / 255.0,
+        n_upper > 0,
+        all_alpha & (n_upper > 0) & (n_lower == 0) & (n_title == 0),
+        all_alpha & first_upper,
+        np.arange(n_tokens) / max(n_tokens - 1, 1) * 0.1,
+    ]).astype(np.float64)
+    
+    std = features.std(axis=0)
+    features = (features - features.mean(axis=0)) / np.where(std > 0, std, 1.0)
+    return features.astype(np.float32)
+
+
+def _write_cache_file(cache_path, save):
+    """
+    Write a cache file by calling save(file) on a temporary file that is then renamed,
+    so that concurrent workers never load a partially written cache file.
+    """
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            save(f)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _vector_cache_path(encoding, kind, suffix):
+    return os.path.join(
+        VECTOR_CACHE_DIR,
+        f"{encoding.name}-{encoding.max_token_value + 1}-{kind}-v{FEATURE_VERSION}{suffix}",
+    )
+
+
+def _get_feature_matrix(encoding):
+    """Return the standardized vocabulary feature matrix of an encoding, memory-mapped from the disk cache"""
+    features = _feature_matrices.get(encoding.name)
+    if features is not None:
+        return features
+    
+    with _feature_matrices_lock:
+        features = _feature_matrices.get(encoding.name)
+        if features is None:
+            cache_path = _vector_cache_path(encoding, "features", ".npy")
+            if not os.path.exists(cache_path):
+                _write_cache_file(cache_path, lambda f: np.save(f, _compute_vocab_features(encoding)))
+            features = np.load(cache_path, mmap_mode="r")
+            _feature_matrices[encoding.name] = features
+    return features
+
+
+def _fit_vocab_projection(features):
+    """
+    Fit a PCA projection over the whole vocabulary feature matrix. The matrix is fed to
+    IncrementalPCA in batches of PROJECTION_BATCH_SIZE rows, so only one batch of the
+    memory-mapped matrix is resident at a time.
+    """
+    n_tokens = features.shape[0]
+    ipca = IncrementalPCA(n_components=PROJECTION_DIMENSIONS)
+    # Evenly sized batches, so that even the last one has at least n_components rows
+    n_batches = max(1, n_tokens // PROJECTION_BATCH_SIZE)
+    bounds = np.linspace(0, n_tokens, num=n_batches + 1, dtype=np.int64)
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        ipca.partial_fit(np.asarray(features[start:end], dtype=np.float64))
+    return {"mean": ipca.mean_, "components": ipca.components_}
+
+
+def _get_vocab_projection(encoding):
+    """Return the projection fitted over the vocabulary of an encoding, loaded from the disk cache"""
+    projection = _projections.get(encoding.name)
+    if projection is not None:
+        return projection
+    
+    with _projections_lock:
+        projection = _projections.get(encoding.name)
+        if projection is None:
+            cache_path = _vector_cache_path(encoding, "projection", ".npz")
+            if not os.path.exists(cache_path):
+                fitted = _fit_vocab_projection(_get_feature_matrix(encoding))
+                _write_cache_file(cache_path, lambda f: np.savez(f, **fitted))
+            with np.load(cache_path) as cached:
+                projection = {"mean": cached["mean"], "components": cached["components"]}
+            _projections[encoding.name] = projection
+    return projection
+
+
+# Encoder registry. Encodings are built from the tiktoken plugin constructors with one
+# lock per encoding, so that the warm-up stage below loads them in parallel (the
+# tiktoken registry holds a single global lock while it constructs an encoding).
+# The configured encodings are warmed up in the background at startup and /readyz
+# reports their load state.
+WARMUP_ENCODINGS = os.environ.get('WARMUP_ENCODINGS', 'all')
+# Out-of-vocabulary pieces to cache per encoding in the native core (0 disables the cache)
+PIECE_CACHE_SIZE = int(os.environ.get('PIECE_CACHE_SIZE', 0))
+# Binary snapshots of the native cores. A snapshot is memory-mapped, so loading one parses
+# nothing, and all worker processes share its pages. Encodings without a usable snapshot are
+# loaded from the tiktoken source files and then snapshotted for the next start;
+# scripts/snapshot.py writes them ahead of time. An empty value disables snapshots.
+TIKTOKEN_SNAPSHOT_DIR = os.environ.get(
+    'TIKTOKEN_SNAPSHOT_DIR', os.path.join(VECTOR_CACHE_DIR, 'snapshots')
+)
+# Failed warm-up loads, such as a failed vocabulary download, are retried in the background
+# up to WARMUP_RETRIES times, WARMUP_RETRY_DELAY seconds after the first failure and twice as
+# long after each next one
+WARMUP_RETRIES = int(os.environ.get('WARMUP_RETRIES', 5))
+WARMUP_RETRY_DELAY = float(os.environ.get('WARMUP_RETRY_DELAY', 2))
+# /readyz fails while a warm-up encoding is not loaded. With WARMUP_READY_ON_FAILURE=true it
+# only waits for the first attempt of each, and reports the ones that failed.
+WARMUP_READY_ON_FAILURE = os.environ.get('WARMUP_READY_ON_FAILURE', 'False').lower() == 'true'
+_encodings = {}
+_encoding_states = {}
+_warm_up_attempted = set()
+_encoding_locks = {}
+_registry_lock = threading.Lock()
+
+
+def _enable_piece_cache(encoding):
+    """Rebuild the native core of an encoding with a piece cache, if the installed core supports one"""
+    core_bpe_type = type(encoding._core_bpe)
+    if not hasattr(core_bpe_type, 'piece_cache_stats'):
+        return
+    encoding._core_bpe = core_bpe_type(
+        encoding._mergeable_ranks, encoding._special_tokens, encoding._pat_str,
+        piece_cache_size=PIECE_CACHE_SIZE,
+    )
+
+
+class _SnapshotRanks(Mapping):
+    """Mergeable ranks of an encoding loaded from a snapshot, read from the native core on first use"""
+    
+    def __init__(self, core_bpe):
+        self._core_bpe = core_bpe
+        self._ranks = None
+    
+    def _get_ranks(self):
+        if self._ranks is None:
+            self._ranks = {
+                token_bytes: self._core_bpe.encode_single_token(token_bytes)
+                for token_bytes in self._core_bpe.token_byte_values()
+            }
+        return self._ranks
+    
+    def __getitem__(self, token_bytes):
+        return self._get_ranks()[token_bytes]
+    
+    def __iter__(self):
+        return iter(self._get_ranks())
+    
+    def __len__(self):
+        return len(self._get_ranks())
+    
+    def items(self):
+        if self._ranks is not None:
+            return self._ranks.items()
+        # Without keeping a dict of the whole vocabulary in every worker process
+        return (
+            (token_bytes, self._core_bpe.encode_single_token(token_bytes))
+            for token_bytes in self._core_bpe.token_byte_values()
+        )
+    
+    def __reduce__(self):
+        # Pickles as a plain dict, which tiktoken.Encoding accepts
+        return dict, (self._get_ranks(),)
+
+
+def _snapshot_path(encoding_name):
+    return os.path.join(TIKTOKEN_SNAPSHOT_DIR, f"{encoding_name}.tkbpe")
+
+
+def _snapshot_fingerprint(encoding_name):
+    """
+    Fingerprint of the source of an encoding, saved in its snapshot. A snapshot with another
+    fingerprint is stale, e.g. after a tiktoken upgrade, and is rebuilt.
+    
+    Hashes the tiktoken version and the module that defines the encoding's constructor, which
+    holds its pattern, its special tokens and the files (and expected hashes) its mergeable ranks
+    are loaded from. So it changes with any of them, without reading the vocabulary.
+    """
+    constructor = tiktoken.registry.ENCODING_CONSTRUCTORS[encoding_name]
+    try:
+        source = inspect.getsource(inspect.getmodule(constructor)).encode()
+    except (OSError, TypeError):
+        # No source file, e.g. a frozen module: the constructor's own code and constants
+        source = marshal.dumps(constructor.__code__)
+    fingerprint = hashlib.sha256()
+    for part in (tiktoken.__version__.encode(), encoding_name.encode(), source):
+        fingerprint.update(len(part).to_bytes(8, 'little'))
+        fingerprint.update(part)
+    return fingerprint.hexdigest()
+
+
+def _snapshots_supported():
+    return bool(TIKTOKEN_SNAPSHOT_DIR) and hasattr(tiktoken._tiktoken.CoreBPE, 'from_snapshot')
+
+
+def _load_snapshot(encoding_name):
+    """Return an encoding built on its memory-mapped snapshot, or None if there is no usable snapshot"""
+    path = _snapshot_path(encoding_name)
+    try:
+        core_bpe = tiktoken._tiktoken.CoreBPE.from_snapshot(
+            path, piece_cache_size=PIECE_CACHE_SIZE, fingerprint=_snapshot_fingerprint(encoding_name)
+        )
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        # Corrupt, stale, or written by an incompatible version: it is replaced after loading the
+        # source files
+        logger.warning("Ignoring snapshot %s: %s", path, e)
+        return None
+    
+    encoding = tiktoken.Encoding.__new__(tiktoken.Encoding)
+    encoding.name = encoding_name
+    encoding._pat_str = core_bpe.pattern
+    encoding._mergeable_ranks = _SnapshotRanks(core_bpe)
+    encoding._special_tokens = core_bpe.special_tokens_encoder
+    encoding.max_token_value = core_bpe.max_token_value
+    encoding._special_token_values = set(encoding._special_tokens.values())
+    encoding._core_bpe = core_bpe
+    return encoding
+
+
+def _save_snapshot(encoding):
+    try:
+        os.makedirs(TIKTOKEN_SNAPSHOT_DIR, exist_ok=True)
+        encoding._core_bpe.save_snapshot(
+            _snapshot_path(encoding.name), fingerprint=_snapshot_fingerprint(encoding.name)
+        )
+    except OSError as e:
+        logger.warning("Failed to write snapshot of %s: %s", encoding.name, e)
+
+
+@contextmanager
+def _snapshot_build_lock(encoding_name):
+    """
+    Hold an exclusive lock on building the snapshot of an encoding, so that when all worker
+    processes start at once only one of them parses the source files. No-op without fcntl.
+    """
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(TIKTOKEN_SNAPSHOT_DIR, exist_ok=True)
+    with open(_snapshot_path(encoding_name) + '.lock', 'wb') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _load_encoding_files(encoding_name):
+    constructor = tiktoken.registry.ENCODING_CONSTRUCTORS[encoding_name]
+    encoding = tiktoken.Encoding(**constructor())
+    if PIECE_CACHE_SIZE:
+        _enable_piece_cache(encoding)
+    return encoding
+
+
+def _load_encoding(encoding_name):
+    """
+    Load an encoding from its snapshot if possible, else from the tiktoken source files.
+    Returns the encoding and its source.
+    
+    Encodings loaded from a snapshot keep their vocabulary in the mapped file, which all
+    worker processes share: only the per-thread regex state is private to a worker, so
+    memory stays flat as the number of workers grows.
+    """
+    if not _snapshots_supported():
+        return _load_encoding_files(encoding_name), "files"
+    
+    encoding = _load_snapshot(encoding_name)
+    if encoding is not None:
+        return encoding, "snapshot"
+    with _snapshot_build_lock(encoding_name):
+        # Another worker may have written the snapshot while this one waited for the lock
+        encoding = _load_snapshot(encoding_name)
+        if encoding is not None:
+            return encoding, "snapshot"
+        encoding = _load_encoding_files(encoding_name)
+        _save_snapshot(encoding)
+    # Map the snapshot just written, so that this worker doesn't keep a private copy either
+    return _load_snapshot(encoding_name) or encoding, "files"
+
+
+def _get_encoding(encoding_name):
+    """Return an encoding, loading it on first use"""
+    encoding = _encodings.get(encoding_name)
+    if encoding is not None:
+        return encoding
+    
+    if encoding_name not in tiktoken.list_encoding_names():
+        raise ValueError(f"Unknown encoding {encoding_name}")
+    with _registry_lock:
+        lock = _encoding_locks.setdefault(encoding_name, threading.Lock())
+    
+    with lock:
+        encoding = _encodings.get(encoding_name)
+        if encoding is None:
+            _encoding_states[encoding_name] = {"state": "loading"}
+            start = time.perf_counter()
+            try:
+                encoding, source = _load_encoding(encoding_name)
+            except Exception as e:
+                _encoding_states[encoding_name] = {"state": "failed", "error": str(e)}
+                raise
+            _encodings[encoding_name] = encoding
+            _encoding_states[encoding_name] = {
+                "state": "ready",
+                "load_seconds": round(time.perf_counter() - start, 3),
+                "source": source,
+            }
+    return encoding
+
+
+def _warm_up_encoding(encoding_name):
+    if encoding_name not in tiktoken.list_encoding_names():
+        # Retrying can't fix the configuration
+        logger.warning("Not warming up unknown encoding %s", encoding_name)
+        _encoding_states[encoding_name] = {"state": "failed", "error": f"Unknown encoding {encoding_name}"}
+        _warm_up_attempted.add(encoding_name)
+        return
+    
+    delay = WARMUP_RETRY_DELAY
+    for attempt in range(WARMUP_RETRIES + 1):
+        try:
+            # The token table is needed by the first /api/encode request as well
+            _get_token_table(_get_encoding(encoding_name))
+            return
+        except Exception as e:
+            logger.warning("Failed to warm up encoding %s (attempt %d): %s", encoding_name, attempt + 1, e)
+        finally:
+            _warm_up_attempted.add(encoding_name)
+        if attempt < WARMUP_RETRIES:
+            time.sleep(delay)
+            delay *= 2
+
+
+def _warm_up_encodings(encoding_names):
+    with ThreadPoolExecutor(max_workers=len(encoding_names), thread_name_prefix='warmup') as pool:
+        list(pool.map(_warm_up_encoding, encoding_names))
+
+
+def _start_warm_up():
+    """Load the encodings configured in WARMUP_ENCODINGS in a background thread"""
+    if WARMUP_ENCODINGS.strip() == 'all':
+        encoding_names = tiktoken.list_encoding_names()
+    else:
+        encoding_names = [name.strip() for name in WARMUP_ENCODINGS.split(',') if name.strip()]
+    
+    for name in encoding_names:
+        _encoding_states.setdefault(name, {"state": "pending"})
+    if encoding_names:
+        threading.Thread(
+            target=_warm_up_encodings, args=(encoding_names,), name='warmup', daemon=True
+        ).start()
+    return encoding_names
+
+
+_warm_up_names = _start_warm_up()
+
 
 @app.route('/')
 def index():
@@ -41,6 +1123,27 @@ def serve_img(filename):
     """Serve image files"""
     return send_from_directory('static/img', filename)
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness probe: the process is up and serving requests"""
+    return jsonify({"status": "ok"})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """Readiness probe: every warm-up encoding has been loaded (or attempted once, see WARMUP_READY_ON_FAILURE)"""
+    states = {name: dict(_encoding_states.get(name, {"state": "pending"})) for name in _warm_up_names}
+    if WARMUP_READY_ON_FAILURE:
+        ready = all(name in _warm_up_attempted for name in _warm_up_names)
+    else:
+        ready = all(state["state"] == "ready" for state in states.values())
+    failed = [name for name, state in states.items() if state["state"] == "failed"]
+    
+    return jsonify({
+        "ready": ready,
+        "failed": failed,
+        "encodings": states
+    }), 200 if ready else 503
+
 @app.route('/api/encodings', methods=['GET'])
 def get_encodings():
     """Get list of all available encodings"""
@@ -50,7 +1153,7 @@ def get_encodings():
     encodings_info = []
     for name in encoding_names:
         try:
-            enc = tiktoken.get_encoding(name)
+            enc = _get_encoding(name)
             info = {
                 "name": name,
                 "vocab_size": enc.n_vocab
@@ -78,49 +1181,345 @@ def encode_text():
     encoding_name = data['encoding']
     allow_special = data.get('allow_special', False)
     special_tokens = data.get('special_tokens', [])
+    truncate = data.get('truncate')
+    token_format = _negotiate_token_format()
+    
+    if truncate is not None and (type(truncate) is not int or truncate < 1):
+        return jsonify({"error": "'truncate' must be a positive integer"}), 400
     
     try:
-        encoding = tiktoken.get_encoding(encoding_name)
-        
-        if allow_special and special_tokens:
-            # Allow specific special tokens
-            tokens = encoding.encode(text, allowed_special=set(special_tokens))
-        else:
-            # Disable all special token checks, treat them as normal text
-            tokens = encoding.encode(text, disallowed_special=())
+        cache_key = _encode_cache_key(encoding_name, text, allow_special, special_tokens)
+        if truncate is not None:
+            cache_key += (truncate,)
+        result = result_cache.get(cache_key)
+        if result is None and token_format:
+            # Binary clients only need the tokens, so skip the token texts and encode
+            # straight into a uint32 array
+            encoding = _get_encoding(encoding_name)
+            if truncate is None:
+                tokens = _encode_to_array(encoding, text, allow_special, special_tokens)
+            else:
+                tokens, _ = _encode_truncated(encoding, text, allow_special, special_tokens, truncate)
+            return Response(_pack_tokens(tokens, token_format), mimetype=token_format)
+        if result is None:
+            encoding = _get_encoding(encoding_name)
+            truncated_at = len(text)
+            if truncate is not None:
+                # Stops encoding at the limit, so the shared cache of full encodes is skipped
+                tokens, truncated_at = _encode_truncated(encoding, text, allow_special, special_tokens, truncate)
+            else:
+                shared_key = _shared_cache_key(cache_key) if shared_cache else None
+                tokens = shared_cache.get(shared_key) if shared_cache else None
+                if tokens is None:
+                    tokens = _encode_with_options(encoding, text, allow_special, special_tokens)
+                    if shared_cache:
+                        shared_cache.put(shared_key, tokens)
+            
+            # Get token text representations and offsets for visualization
+            _, token_texts, token_offsets = _decode_token_spans(encoding, tokens)
+            
+            result = {
+                "tokens": tokens,
+                "token_count": len(tokens),
+                "token_texts": token_texts,
+                "token_offsets": token_offsets
+            }
+            if truncate is not None:
+                result["truncated"] = truncated_at < len(text)
+                result["truncated_at"] = truncated_at
+            result_cache.put(cache_key, result, len(tokens) * _ENCODED_TOKEN_SIZE + _CACHE_ENTRY_OVERHEAD)
         
-        # Get token text representations for visualization
-        token_texts = []
-        for token in tokens:
-            try:
-                token_text = encoding.decode([token])
-                token_texts.append(token_text)
-            except:
-                token_texts.append("[SPECIAL]")
+        if token_format:
+            return Response(_pack_tokens(result["tokens"], token_format), mimetype=token_format)
+        return jsonify(result)
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/encode_batch', methods=['POST'])
+def encode_batch():
+    """Encode a list of texts into tokens in one call"""
+    data = request.json
+    
+    if not data or 'texts' not in data or 'encoding' not in data:
+        return jsonify({"error": "Missing required parameters"}), 400
+    
+    texts = data['texts']
+    encoding_name = data['encoding']
+    allow_special = data.get('allow_special', False)
+    special_tokens = data.get('special_tokens', [])
+    
+    if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        return jsonify({"error": "'texts' must be a list of strings"}), 400
+    if len(texts) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"Batch too large, at most {MAX_BATCH_SIZE} texts are allowed"}), 413
+    
+    try:
+        encoding = _get_encoding(encoding_name)
+        batch_tokens = _encode_batch_with_options(encoding, texts, allow_special, special_tokens)
         
         return jsonify({
-            "tokens": tokens,
-            "token_count": len(tokens),
-            "token_texts": token_texts
+            "results": [
+                {"tokens": tokens, "token_count": len(tokens)} for tokens in batch_tokens
+            ],
+            "total_tokens": sum(len(tokens) for tokens in batch_tokens)
         })
     
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/decode', methods=['POST'])
-def decode_tokens():
-    """Decode tokens back to text"""
+@app.route('/api/count', methods=['POST'])
+def count_text():
+    """Count the tokens of a text without returning them"""
     data = request.json
     
-    if not data or 'tokens' not in data or 'encoding' not in data:
+    if not data or 'text' not in data or 'encoding' not in data:
         return jsonify({"error": "Missing required parameters"}), 400
     
-    tokens = data['tokens']
+    text = data['text']
     encoding_name = data['encoding']
+    allow_special = data.get('allow_special', False)
+    special_tokens = data.get('special_tokens', [])
     
     try:
-        encoding = tiktoken.get_encoding(encoding_name)
-        text = encoding.decode(tokens)
+        # Reuse a cached /api/encode result if there is one. Counts aren't cached, so peek without
+        # counting the lookup in the hit rate of the encode results.
+        result = result_cache.peek(_encode_cache_key(encoding_name, text, allow_special, special_tokens))
+        if result is not None:
+            return jsonify({"token_count": result["token_count"]})
+        
+        encoding = _get_encoding(encoding_name)
+        return jsonify({"token_count": _count_with_options(encoding, text, allow_special, special_tokens)})
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/count_batch', methods=['POST'])
+def count_batch():
+    """Count the tokens of a list of texts in one call"""
+    data = request.json
+    
+    if not data or 'texts' not in data or 'encoding' not in data:
+        return jsonify({"error": "Missing required parameters"}), 400
+    
+    texts = data['texts']
+    encoding_name = data['encoding']
+    allow_special = data.get('allow_special', False)
+    special_tokens = data.get('special_tokens', [])
+    
+    if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        return jsonify({"error": "'texts' must be a list of strings"}), 400
+    if len(texts) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"Batch too large, at most {MAX_BATCH_SIZE} texts are allowed"}), 413
+    
+    try:
+        encoding = _get_encoding(encoding_name)
+        counts = list(encode_pool.map(
+            lambda text: _count_with_options(encoding, text, allow_special, special_tokens),
+            texts,
+        ))
+        
+        return jsonify({"token_counts": counts, "total_tokens": sum(counts)})
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/chunk', methods=['POST'])
+def chunk_text():
+    """Split a text into chunks of at most max_tokens tokens, overlapping by overlap tokens"""
+    data = request.json
+    
+    if not data or 'text' not in data or 'encoding' not in data or 'max_tokens' not in data:
+        return jsonify({"error": "Missing required parameters"}), 400
+    
+    text = data['text']
+    encoding_name = data['encoding']
+    allow_special = data.get('allow_special', False)
+    special_tokens = data.get('special_tokens', [])
+    
+    sizes = _chunk_sizes(data)
+    if sizes is None:
+        return jsonify({"error": "'max_tokens' must be a positive integer and 'overlap' an integer from 0 to max_tokens - 1"}), 400
+    
+    try:
+        encoding = _get_encoding(encoding_name)
+        [(tokens, chunks)] = _chunk_batch_with_options(encoding, [text], allow_special, special_tokens, *sizes)
+        return jsonify(_chunk_result(text, tokens, chunks))
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/chunk_batch', methods=['POST'])
+def chunk_batch():
+    """Split a list of texts into chunks of at most max_tokens tokens in one call"""
+    data = request.json
+    
+    if not data or 'texts' not in data or 'encoding' not in data or 'max_tokens' not in data:
+        return jsonify({"error": "Missing required parameters"}), 400
+    
+    texts = data['texts']
+    encoding_name = data['encoding']
+    allow_special = data.get('allow_special', False)
+    special_tokens = data.get('special_tokens', [])
+    
+    if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        return jsonify({"error": "'texts' must be a list of strings"}), 400
+    if len(texts) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"Batch too large, at most {MAX_BATCH_SIZE} texts are allowed"}), 413
+    sizes = _chunk_sizes(data)
+    if sizes is None:
+        return jsonify({"error": "'max_tokens' must be a positive integer and 'overlap' an integer from 0 to max_tokens - 1"}), 400
+    
+    try:
+        encoding = _get_encoding(encoding_name)
+        results = _chunk_batch_with_options(encoding, texts, allow_special, special_tokens, *sizes)
+        return jsonify({
+            "results": [_chunk_result(text, tokens, chunks) for text, (tokens, chunks) in zip(texts, results)]
+        })
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/encode_stream', methods=['POST'])
+def encode_stream():
+    """
+    Encode a (possibly chunked) raw text request body incrementally.
+    
+    The encoding and special token options are passed as query parameters. The body is
+    consumed in chunks and cut only at positions where tokenization is stable, and the
+    tokens of each piece are streamed back as NDJSON lines as soon as they are produced,
+    so memory stays constant however large the upload is.
+    """
+    encoding_name = request.args.get('encoding')
+    allow_special = request.args.get('allow_special', 'false').lower() == 'true'
+    special_tokens = [t for t in request.args.get('special_tokens', '').split(',') if t]
+    
+    if not encoding_name:
+        return jsonify({"error": "Missing required parameters"}), 400
+    try:
+        encoding = _get_encoding(encoding_name)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+    
+    stream = request.stream
+    allowed_special = _encode_options(allow_special, special_tokens).get("allowed_special", set())
+    streaming_encoder = getattr(encoding._core_bpe, 'streaming_encoder', None)
+    
+    def generate_native():
+        # The native streaming encoder holds back text until it can be cut at a stable
+        # position itself, so every chunk is only scanned and encoded once
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        stream_encoder = streaming_encoder(allowed_special)
+        token_count = 0
+        try:
+            while True:
+                chunk = stream.read(STREAM_READ_SIZE)
+                final = not chunk
+                text_offset = stream_encoder.committed_chars
+                tokens = stream_encoder.push(decoder.decode(chunk, final=final))
+                if final:
+                    tokens += stream_encoder.finish()
+                
+                if tokens:
+                    yield json.dumps({
+                        "tokens": tokens,
+                        "token_count": len(tokens),
+                        "text_offset": text_offset
+                    }) + "\n"
+                    token_count += len(tokens)
+                
+                if final:
+                    break
+            
+            yield json.dumps({"done": True, "token_count": token_count}) + "\n"
+        
+        except Exception as e:
+            yield json.dumps({"error": str(e)}) + "\n"
+    
+    def generate():
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        pending = ""
+        scan_from = 1
+        text_offset = 0
+        token_count = 0
+        try:
+            while True:
+                chunk = stream.read(STREAM_READ_SIZE)
+                final = not chunk
+                pending += decoder.decode(chunk, final=final)
+                
+                split = len(pending) if final else _stable_split_point(pending, scan_from)
+                if split is None:
+                    # Positions before the end have no split point, don't scan them again
+                    scan_from = len(pending)
+                    continue
+                
+                if split > 0:
+                    tokens = _encode_with_options(encoding, pending[:split], allow_special, special_tokens)
+                    yield json.dumps({
+                        "tokens": tokens,
+                        "token_count": len(tokens),
+                        "text_offset": text_offset
+                    }) + "\n"
+                    token_count += len(tokens)
+                    text_offset += split
+                    pending = pending[split:]
+                    scan_from = 1
+                
+                if final:
+                    break
+            
+            yield json.dumps({"done": True, "token_count": token_count}) + "\n"
+        
+        except Exception as e:
+            yield json.dumps({"error": str(e)}) + "\n"
+    
+    # Special tokens that are not allowed must raise an error like Encoding.encode does,
+    # which only the Python path checks
+    if streaming_encoder is not None and not (allowed_special and encoding.special_tokens_set - allowed_special):
+        return Response(stream_with_context(generate_native()), mimetype='application/x-ndjson')
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/api/decode', methods=['POST'])
+def decode_tokens():
+    """Decode tokens back to text"""
+    if request.mimetype in _TOKENS_MAGIC:
+        # Binary token payload, the encoding is passed as a query parameter
+        encoding_name = request.args.get('encoding')
+        if not encoding_name:
+            return jsonify({"error": "Missing required parameters"}), 400
+        with_offsets = request.args.get('offsets') == 'true'
+        try:
+            tokens = _unpack_tokens(request.get_data(), request.mimetype).tolist()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    else:
+        data = request.json
+        
+        if not data or 'tokens' not in data or 'encoding' not in data:
+            return jsonify({"error": "Missing required parameters"}), 400
+        
+        tokens = data['tokens']
+        encoding_name = data['encoding']
+        with_offsets = bool(data.get('offsets', False))
+    
+    try:
+        cache_key = _decode_cache_key(encoding_name, tokens)
+        if with_offsets:
+            cache_key = ("decode_offsets",) + cache_key[1:]
+            result = result_cache.get(cache_key)
+            if result is None:
+                encoding = _get_encoding(encoding_name)
+                text, token_offsets = _decode_with_offsets(encoding, tokens)
+                result = {"text": text, "token_offsets": token_offsets}
+                result_cache.put(cache_key, result, len(text) * 4 + len(tokens) * _ENCODED_TOKEN_SIZE + _CACHE_ENTRY_OVERHEAD)
+            return jsonify(result)
+        
+        text = result_cache.get(cache_key)
+        if text is None:
+            encoding = _get_encoding(encoding_name)
+            text = encoding.decode(tokens)
+            result_cache.put(cache_key, text, len(text) * 4 + _CACHE_ENTRY_OVERHEAD)
         
         return jsonify({
             "text": text
@@ -129,6 +1528,22 @@ def decode_tokens():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/cache_stats', methods=['GET'])
+def cache_stats():
+    """Get hit/miss statistics of the encode/decode result caches and the native piece caches"""
+    stats = result_cache.stats()
+    if shared_cache:
+        stats["shared"] = shared_cache.stats()
+    piece_stats = {}
+    for encoding_name, encoding in list(_encodings.items()):
+        get_piece_stats = getattr(encoding._core_bpe, 'piece_cache_stats', None)
+        encoding_piece_stats = get_piece_stats() if get_piece_stats else None
+        if encoding_piece_stats is not None:
+            piece_stats[encoding_name] = encoding_piece_stats
+    if piece_stats:
+        stats["pieces"] = piece_stats
+    return jsonify(stats)
+
 @app.route('/api/token_info', methods=['POST'])
 def get_token_info():
     """Get information about a specific token"""
@@ -141,7 +1556,7 @@ def get_token_info():
     encoding_name = data['encoding']
     
     try:
-        encoding = tiktoken.get_encoding(encoding_name)
+        encoding = _get_encoding(encoding_name)
         # Decode the token to get its text representation
         text = encoding.decode([token])
         
@@ -164,7 +1579,7 @@ def get_token_info():
 def get_encoding_info(encoding_name):
     """Get detailed information about a specific encoding"""
     try:
-        encoding = tiktoken.get_encoding(encoding_name)
+        encoding = _get_encoding(encoding_name)
         
         info = {
             "name": encoding_name,
@@ -203,122 +1618,41 @@ def tokens_to_vectors():
     
     if not tokens:
         return jsonify({'error': 'No tokens provided'})
+    if not isinstance(dimensions, int) or not 1 <= dimensions <= PROJECTION_DIMENSIONS:
+        return jsonify({'error': f'dimensions must be between 1 and {PROJECTION_DIMENSIONS}'})
     
     try:
         # 获取当前的编码器
-        encoding = tiktoken.get_encoding(encoding_name)
+        encoding = _get_encoding(encoding_name)
         
-        # 对每个token进行解码，获取其文本表示
-        token_texts = []
-        valid_tokens = []
+        # 从预先计算好的词表特征矩阵中取出每个token的特征行
+        features = _get_feature_matrix(encoding)
+        token_ids = np.asarray(tokens, dtype=np.int64)
+        valid = (token_ids >= 0) & (token_ids < features.shape[0])
+        X = np.take(features, token_ids, axis=0, mode='clip')
+        # 无法解码的token使用全零特征 (即词表的平均值)
+        X[~valid] = 0
         
-        for token in tokens:
-            try:
-                # 将token ID转换为字节，然后解码为文本
-                text = encoding.decode([token])
-                token_texts.append(text)
-                valid_tokens.append(token)
-            except Exception as e:
-                # 如果无法解码，使用空字符串
-                print(f"Error decoding token {token}: {e}")
-                token_texts.append("")
-                valid_tokens.append(token)
+        # 获取每个token的文本表示
+        all_texts = _get_token_table(encoding)["texts"]
+        token_texts = [
+            (all_texts[token] or "") if is_valid else ""
+            for token, is_valid in zip(tokens, valid.tolist())
+        ]
         
-        # 从token文本中提取特征
-        features = []
+        # 使用在整个词表上预先拟合好的PCA投影降维到指定维度
+        projection = _get_vocab_projection(encoding)
+        components = projection["components"][:dimensions]
+        # 放大向量以便在3D空间中显示
+        vectors_reduced = (X - projection["mean"]) @ components.T * 10.0  # 放大10倍以便在视觉上更明显
         
-        for i, text in enumerate(token_texts):
-            token_features = []
-            
-            # 特征1: 文本长度 (归一化)
-            length = len(text) / 10.0 if text else 0
-            token_features.append(length)
-            
-            # 特征2: 字符类型比例
-            if text:
-                alpha_ratio = sum(c.isalpha() for c in text) / len(text)
-                digit_ratio = sum(c.isdigit() for c in text) / len(text)
-                space_ratio = sum(c.isspace() for c in text) / len(text)
-                punct_ratio = sum(not c.isalnum() and not c.isspace() for c in text) / len(text)
-            else:
-                alpha_ratio, digit_ratio, space_ratio, punct_ratio = 0, 0, 0, 0
-            
-            token_features.extend([alpha_ratio, digit_ratio, space_ratio, punct_ratio])
-            
-            # 特征3: 字符ASCII值的平均值和标准差
-            if text:
-                ascii_values = [ord(c) for c in text]
-                avg_ascii = sum(ascii_values) / len(ascii_values) / 255.0  # 归一化
-                std_ascii = np.std(ascii_values) / 128.0 if len(ascii_values) > 1 else 0
-            else:
-                avg_ascii, std_ascii = 0, 0
-            
-            token_features.extend([avg_ascii, std_ascii])
-            
-            # 特征4: 是否为常见分词类型 (特殊字符、单词、数字等)
-            is_single_char = len(text) == 1
-            is_word = text.isalpha() and len(text) > 1
-            is_number = text.isdigit()
-            is_special = not text.isalnum() and len(text) > 0
-            
-            token_features.extend([
-                float(is_single_char),
-                float(is_word), 
-                float(is_number),
-                float(is_special)
-            ])
-            
-            # 特征5: 首字符和尾字符的位置
-            if text:
-                first_char_pos = ord(text[0]) / 255.0
-                last_char_pos = ord(text[-1]) / 255.0
-            else:
-                first_char_pos, last_char_pos = 0, 0
-                
-            token_features.extend([first_char_pos, last_char_pos])
-            
-            # 特征6: 语言特征 - 简单的启发式判断是否为英文、数字等
-            has_uppercase = any(c.isupper() for c in text) if text else False
-            all_uppercase = text.isupper() if text and text.isalpha() else False
-            starts_uppercase = text[0].isupper() if text and text.isalpha() else False
-            
-            token_features.extend([
-                float(has_uppercase),
-                float(all_uppercase),
-                float(starts_uppercase)
-            ])
-            
-            # 将 token ID 作为辅助特征 (但权重较低)
-            token_id_norm = float(valid_tokens[i]) / max(max(valid_tokens), 1) * 0.1
-            token_features.append(token_id_norm)
-            
-            features.append(token_features)
+        # 将降维后的向量和原始token ID关联起来
+        result = [
+            {'token': token, 'text': text, 'vector': vector}
+            for token, text, vector in zip(tokens, token_texts, vectors_reduced.tolist())
+        ]
         
-        # 转换为numpy数组
-        X = np.array(features)
-        
-        if X.shape[0] > 0:
-            # 使用StandardScaler标准化特征
-            X = StandardScaler().fit_transform(X)
-            
-            # 使用PCA降维到指定维度
-            pca = PCA(n_components=dimensions)
-            vectors_reduced = pca.fit_transform(X)
-            
-            # 将降维后的向量和原始token ID关联起来
-            result = []
-            for i, token in enumerate(valid_tokens):
-                # 放大向量以便在3D空间中显示
-                vector = vectors_reduced[i] * 10.0  # 放大10倍以便在视觉上更明显
-                result.append({
-                    'token': token,
-                    'text': token_texts[i],
-                    'vector': vector.tolist()
-                })
-            
-            return jsonify({'vectors': result})
-        else:
-            return jsonify({'error': 'No valid features could be extracted'})
+        return jsonify({'vectors': result})
             
     except Exception as e:
         import traceback
@@ -5,7 +5,8 @@ import json
 import os
 import random
 import time
-from typing import Any, cast
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional, cast
 
 import blobfile
 
@@ -37,3 +38,146 @@ def benchmark_batch(documents: list[str]) -> None:
     print(f"huggingface \t{num_bytes / (end - start) * 1e9} bytes / s")
 
 
+def benchmark_encodings(
+    documents: list[str], encoding_names: tuple[str, ...] = ("cl100k_base", "o200k_base")
+) -> None:
+    # Single threaded, so it measures the BPE merge loop rather than thread scaling.
+    # Run it against two builds to compare them.
+    num_bytes = sum(map(len, map(str.encode, documents)))
+    print(f"num_bytes: {num_bytes}")
+
+    for encoding_name in encoding_names:
+        enc = tiktoken.get_encoding(encoding_name)
+        enc.encode("warmup")
+
+        start = time.perf_counter_ns()
+        for document in documents:
+            enc.encode_ordinary(document)
+        end = time.perf_counter_ns()
+        print(f"{encoding_name} \t{num_bytes / (end - start) * 1e9} bytes / s")
+
+
+def benchmark_threads(documents: list[str], encoding_name: str = "o200k_base") -> None:
+    # Encodes the same documents from 1 to 64 threads of one shared Encoding. With no contention
+    # on the per-thread regex clones, throughput grows with threads up to the core count.
+    num_bytes = sum(map(len, map(str.encode, documents)))
+    print(f"num_bytes: {num_bytes}, cpus: {os.cpu_count()}")
+
+    enc = tiktoken.get_encoding(encoding_name)
+    enc.encode("warmup")
+
+    for num_threads in [1, 2, 4, 8, 16, 32, 64]:
+        with ThreadPoolExecutor(num_threads) as executor:
+            start = time.perf_counter_ns()
+            list(executor.map(enc.encode_ordinary, documents))
+            end = time.perf_counter_ns()
+        print(f"{num_threads} threads \t{num_bytes / (end - start) * 1e9} bytes / s")
+
+
+def benchmark_special_lookalikes(encoding_name: str = "cl100k_base", repeat: int = 20000) -> None:
+    # Text full of special token lookalikes and special tokens that aren't allowed, which the
+    # special token scan of encode has to look at and skip. Calls the core directly, since
+    # Encoding.encode rejects text with special tokens that aren't allowed.
+    unit = " hello <|endoftext <|fim_prefix|> <|endoftext|> world <|endofprompt <| |> <|endoftex|>"
+    text = unit * repeat
+    num_bytes = len(text.encode())
+    print(f"num_bytes: {num_bytes}")
+
+    enc = tiktoken.get_encoding(encoding_name)
+    enc.encode("warmup")
+
+    for label, allowed_special in [
+        ("one allowed", {"<|endoftext|>"}),
+        ("all allowed", enc.special_tokens_set),
+    ]:
+        start = time.perf_counter_ns()
+        enc._core_bpe.encode(text, allowed_special)
+        end = time.perf_counter_ns()
+        print(f"{label} \t{num_bytes / (end - start) * 1e9} bytes / s")
+
+
+def _rss_bytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def benchmark_memory(encoding_name: str = "o200k_base") -> None:
+    # Resident memory of one CoreBPE, not counting the Python dict of ranks it is built from.
+    # Run it against two builds to compare them. Linux only.
+    from tiktoken import _tiktoken
+    from tiktoken_ext.openai_public import ENCODING_CONSTRUCTORS
+
+    constructor_kwargs = ENCODING_CONSTRUCTORS[encoding_name]()
+    before = _rss_bytes()
+    core_bpe = _tiktoken.CoreBPE(
+        constructor_kwargs["mergeable_ranks"],
+        constructor_kwargs["special_tokens"],
+        constructor_kwargs["pat_str"],
+    )
+    after = _rss_bytes()
+    core_bpe.encode_ordinary("warmup")
+    print(f"{encoding_name} \t{(after - before) / 2**20:.1f} MiB RSS")
+
+
+def _private_bytes() -> int:
+    # Pages mapped by this process only. Pages of a file that other processes map too, such
+    # as a snapshot, count as shared. Linux only.
+    with open("/proc/self/smaps_rollup") as f:
+        return sum(
+            int(line.split()[1]) * 1024
+            for line in f
+            if line.startswith(("Private_Clean:", "Private_Dirty:"))
+        )
+
+
+def _load_core_bpe(
+    snapshot_path: Optional[str], encoding_name: str, barrier: Any, results: Any
+) -> None:
+    from tiktoken import _tiktoken
+    from tiktoken_ext.openai_public import ENCODING_CONSTRUCTORS
+
+    if snapshot_path is None:
+        constructor_kwargs = ENCODING_CONSTRUCTORS[encoding_name]()
+    before = _private_bytes()
+    if snapshot_path is None:
+        core_bpe = _tiktoken.CoreBPE(
+            constructor_kwargs["mergeable_ranks"],
+            constructor_kwargs["special_tokens"],
+            constructor_kwargs["pat_str"],
+        )
+    else:
+        core_bpe = _tiktoken.CoreBPE.from_snapshot(snapshot_path)
+    core_bpe.encode_ordinary("warmup " * 1000)
+    # Measure once every process has loaded, so that the pages they share count as shared
+    barrier.wait()
+    results.put(_private_bytes() - before)
+    barrier.wait()
+
+
+def benchmark_shared_memory(encoding_name: str = "o200k_base", num_processes: int = 16) -> None:
+    # Private memory that num_processes worker processes each add for one CoreBPE, built from the
+    # vocabulary files or mapped from one snapshot. The snapshot stays flat as processes grow.
+    import multiprocessing
+    import tempfile
+
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        snapshot_path = os.path.join(tmp_dir, f"{encoding_name}.tkbpe")
+        tiktoken.get_encoding(encoding_name)._core_bpe.save_snapshot(snapshot_path)
+
+        for label, path in [("files", None), ("snapshot", snapshot_path)]:
+            barrier = ctx.Barrier(num_processes)
+            results = ctx.Queue()
+            processes = [
+                ctx.Process(target=_load_core_bpe, args=(path, encoding_name, barrier, results))
+                for _ in range(num_processes)
+            ]
+            for process in processes:
+                process.start()
+            private = [results.get() for _ in processes]
+            for process in processes:
+                process.join()
+            print(
+                f"{label} \t{num_processes} processes, "
+                f"{sum(private) / len(private) / 2**20:.1f} MiB private each"
+            )
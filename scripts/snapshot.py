@@ -0,0 +1,43 @@
+import argparse
+import os
+import sys
+import time
+
+import tiktoken
+
+
+def snapshot(encoding_names: list[str], output_dir: str) -> None:
+    # Writes <output_dir>/<name>.tkbpe for each encoding, for CoreBPE.from_snapshot. Run it at
+    # build or deploy time and point TIKTOKEN_SNAPSHOT_DIR of the app at the output directory.
+    # The snapshots carry the app's fingerprint of each encoding, or the app rebuilds them.
+    os.environ.setdefault("WARMUP_ENCODINGS", "")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from app import _snapshot_fingerprint
+
+    os.makedirs(output_dir, exist_ok=True)
+    for encoding_name in encoding_names:
+        enc = tiktoken.get_encoding(encoding_name)
+        path = os.path.join(output_dir, f"{encoding_name}.tkbpe")
+        fingerprint = _snapshot_fingerprint(encoding_name)
+        enc._core_bpe.save_snapshot(path, fingerprint=fingerprint)
+
+        start = time.perf_counter_ns()
+        core_bpe = type(enc._core_bpe).from_snapshot(path, fingerprint=fingerprint)
+        end = time.perf_counter_ns()
+        assert core_bpe.encode_ordinary("hello world") == enc.encode_ordinary("hello world")
+        print(
+            f"{encoding_name} \t{os.path.getsize(path) / 2**20:.1f} MiB, "
+            f"loads in {(end - start) / 1e6:.2f} ms"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_dir")
+    parser.add_argument("encodings", nargs="*", default=tiktoken.list_encoding_names())
+    args = parser.parse_args()
+    snapshot(args.encodings, args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
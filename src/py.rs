@@ -1,32 +1,53 @@
 use std::collections::HashSet;
+use std::path::PathBuf;
 
 use pyo3::{
+    buffer::PyBuffer,
     exceptions,
     prelude::*,
     pybacked::PyBackedStr,
-    types::{PyBytes, PyList, PyTuple},
+    types::{PyBytes, PyDict, PyList, PyTuple},
     PyResult,
 };
 use rustc_hash::FxHashMap as HashMap;
 
-use crate::{byte_pair_encode, CoreBPE, Rank};
+use crate::{CoreBPE, Rank, SnapshotError, StreamingEncoder, TokenChunk};
 
 #[pymethods]
 impl CoreBPE {
     #[new]
+    #[pyo3(signature = (encoder, special_tokens_encoder, pattern, piece_cache_size = 0))]
     fn py_new(
         encoder: HashMap<Vec<u8>, Rank>,
         special_tokens_encoder: HashMap<String, Rank>,
         pattern: &str,
+        piece_cache_size: usize,
     ) -> PyResult<Self> {
         Self::new_internal(
             encoder,
             special_tokens_encoder,
             pattern,
         )
+        .map(|bpe| bpe.with_piece_cache(piece_cache_size))
         .map_err(|e| PyErr::new::<exceptions::PyValueError, _>(e.to_string()))
     }
 
+    /// Maps a snapshot written by `save_snapshot`, without parsing the vocabulary. Raises
+    /// `OSError` if the file can't be read and `ValueError` if it is not a valid snapshot, or
+    /// if `fingerprint` is given and the snapshot was saved with another one.
+    #[staticmethod]
+    #[pyo3(name = "from_snapshot", signature = (path, piece_cache_size = 0, fingerprint = None))]
+    fn py_from_snapshot(
+        py: Python,
+        path: PathBuf,
+        piece_cache_size: usize,
+        fingerprint: Option<&str>,
+    ) -> PyResult<Self> {
+        py.allow_threads(|| Self::from_snapshot(path, fingerprint))
+            .map(|bpe| bpe.with_piece_cache(piece_cache_size))
+            .map_err(snapshot_error)
+    }
+
     // ====================
     // Encoding
     // ====================
@@ -65,6 +86,145 @@ impl CoreBPE {
         buffer.into_py(py)
     }
 
+    #[pyo3(name = "count_ordinary")]
+    fn py_count_ordinary(&self, py: Python, text: &str) -> usize {
+        py.allow_threads(|| self.count_ordinary(text))
+    }
+
+    #[pyo3(name = "count_tokens")]
+    fn py_count_tokens(
+        &self,
+        py: Python,
+        text: &str,
+        allowed_special: HashSet<PyBackedStr>,
+    ) -> usize {
+        py.allow_threads(|| {
+            let allowed_special: HashSet<&str> =
+                allowed_special.iter().map(|s| s.as_ref()).collect();
+            self.count_tokens(text, &allowed_special)
+        })
+    }
+
+    /// Encodes at most `max_tokens` tokens of `text`, stopping early once the limit is reached.
+    ///
+    /// Returns `(tokens, char_offset)`: the tokens cover the first `char_offset` characters of
+    /// `text`, not counting a character the last token only partially covers.
+    #[pyo3(name = "encode_with_limit")]
+    fn py_encode_with_limit(
+        &self,
+        py: Python,
+        text: &str,
+        allowed_special: HashSet<PyBackedStr>,
+        max_tokens: usize,
+    ) -> (Vec<Rank>, usize) {
+        py.allow_threads(|| {
+            let allowed_special: HashSet<&str> =
+                allowed_special.iter().map(|s| s.as_ref()).collect();
+            let (tokens, offset) = self.encode_with_limit(text, &allowed_special, max_tokens);
+            (tokens, char_count_before(text, offset))
+        })
+    }
+
+    #[pyo3(name = "encode_ordinary_with_limit")]
+    fn py_encode_ordinary_with_limit(
+        &self,
+        py: Python,
+        text: &str,
+        max_tokens: usize,
+    ) -> (Vec<Rank>, usize) {
+        py.allow_threads(|| {
+            let (tokens, offset) = self.encode_ordinary_with_limit(text, max_tokens);
+            (tokens, char_count_before(text, offset))
+        })
+    }
+
+    /// Encodes a list of texts on `num_threads` threads, with the GIL released throughout.
+    ///
+    /// Returns `(tokens, offsets)` as buffers of u32 and u64: the tokens of `texts[i]` are
+    /// `tokens[offsets[i]:offsets[i + 1]]`.
+    #[pyo3(name = "encode_batch")]
+    fn py_encode_batch(
+        &self,
+        py: Python,
+        texts: Vec<PyBackedStr>,
+        allowed_special: HashSet<PyBackedStr>,
+        num_threads: usize,
+    ) -> Py<PyTuple> {
+        let (tokens, offsets) = py.allow_threads(|| {
+            let texts: Vec<&str> = texts.iter().map(|s| s.as_ref()).collect();
+            let allowed_special: HashSet<&str> =
+                allowed_special.iter().map(|s| s.as_ref()).collect();
+            self.encode_batch(&texts, &allowed_special, num_threads)
+        });
+        (
+            TiktokenBuffer { tokens }.into_py(py),
+            TiktokenOffsetsBuffer { offsets }.into_py(py),
+        )
+            .into_py(py)
+    }
+
+    /// Encodes `text` and splits its tokens into chunks of at most `max_tokens` tokens that
+    /// overlap by `overlap` tokens.
+    ///
+    /// Returns `(tokens, chunks)`, with a `(token_start, token_end, char_start, char_end)`
+    /// tuple per chunk. A character split between two tokens belongs to both of their chunks.
+    #[pyo3(name = "chunk_by_tokens")]
+    fn py_chunk_by_tokens(
+        &self,
+        py: Python,
+        text: &str,
+        allowed_special: HashSet<PyBackedStr>,
+        max_tokens: usize,
+        overlap: usize,
+    ) -> PyResult<(Vec<Rank>, Vec<ChunkRanges>)> {
+        check_chunk_sizes(max_tokens, overlap)?;
+        Ok(py.allow_threads(|| {
+            let allowed_special: HashSet<&str> =
+                allowed_special.iter().map(|s| s.as_ref()).collect();
+            let (tokens, chunks) =
+                self.chunk_by_tokens(text, &allowed_special, max_tokens, overlap);
+            (tokens, chunk_char_ranges(text, &chunks))
+        }))
+    }
+
+    /// Runs `chunk_by_tokens` for every text in `texts` on `num_threads` threads, with the GIL
+    /// released throughout.
+    #[pyo3(name = "chunk_batch")]
+    fn py_chunk_batch(
+        &self,
+        py: Python,
+        texts: Vec<PyBackedStr>,
+        allowed_special: HashSet<PyBackedStr>,
+        max_tokens: usize,
+        overlap: usize,
+        num_threads: usize,
+    ) -> PyResult<Vec<(Vec<Rank>, Vec<ChunkRanges>)>> {
+        check_chunk_sizes(max_tokens, overlap)?;
+        Ok(py.allow_threads(|| {
+            let texts: Vec<&str> = texts.iter().map(|s| s.as_ref()).collect();
+            let allowed_special: HashSet<&str> =
+                allowed_special.iter().map(|s| s.as_ref()).collect();
+            let results =
+                self.chunk_batch(&texts, &allowed_special, max_tokens, overlap, num_threads);
+            texts
+                .iter()
+                .zip(results)
+                .map(|(text, (tokens, chunks))| (tokens, chunk_char_ranges(text, &chunks)))
+                .collect()
+        }))
+    }
+
+    /// Returns a `StreamingEncoder` for text that arrives in chunks.
+    fn streaming_encoder(
+        slf: PyRef<'_, Self>,
+        allowed_special: HashSet<String>,
+    ) -> PyStreamingEncoder {
+        PyStreamingEncoder {
+            core_bpe: slf.into(),
+            encoder: StreamingEncoder::new(allowed_special),
+        }
+    }
+
     fn _encode_bytes(&self, py: Python, bytes: &[u8]) -> Vec<Rank> {
         py.allow_threads(|| {
             match std::str::from_utf8(bytes) {
@@ -96,11 +256,9 @@ impl CoreBPE {
                     }
 
                     if !unstable_bytes.is_empty() {
-                        match self.encoder.get(&unstable_bytes) {
-                            Some(token) => tokens.push(*token),
-                            None => {
-                                tokens.extend(&byte_pair_encode(&unstable_bytes, &self.encoder))
-                            }
+                        match self.vocab.get(&unstable_bytes) {
+                            Some(token) => tokens.push(token),
+                            None => tokens.extend(&self._byte_pair_encode(&unstable_bytes)),
                         }
                     }
                     tokens
@@ -131,7 +289,7 @@ impl CoreBPE {
     }
 
     fn encode_single_token(&self, piece: &[u8]) -> PyResult<Rank> {
-        if let Some(token) = self.encoder.get(piece).copied() {
+        if let Some(token) = self.vocab.get(piece) {
             return Ok(token);
         }
         if let Ok(piece_str) = std::str::from_utf8(piece) {
@@ -143,10 +301,10 @@ impl CoreBPE {
     }
 
     fn encode_single_piece(&self, piece: &[u8]) -> Vec<Rank> {
-        if let Some(token) = self.encoder.get(piece) {
-            return vec![*token];
+        if let Some(token) = self.vocab.get(piece) {
+            return vec![token];
         }
-        byte_pair_encode(piece, &self.encoder)
+        self._byte_pair_encode(piece)
     }
 
     // ====================
@@ -161,8 +319,103 @@ impl CoreBPE {
         }
     }
 
+    /// Decodes tokens into a string and the char offset of every token in it, see
+    /// `Encoding.decode_with_offsets`. Raises UnicodeDecodeError if the tokens don't decode
+    /// to valid UTF-8.
+    #[pyo3(name = "decode_with_offsets")]
+    fn py_decode_with_offsets(
+        &self,
+        py: Python,
+        tokens: Vec<Rank>,
+    ) -> PyResult<(String, Vec<usize>)> {
+        let (bytes, offsets) = py
+            .allow_threads(|| self.decode_with_offsets(&tokens))
+            .map_err(|e| exceptions::PyKeyError::new_err(format!("{}", e)))?;
+        match String::from_utf8(bytes) {
+            Ok(text) => Ok((text, offsets)),
+            Err(e) => {
+                let err = exceptions::PyUnicodeDecodeError::new_utf8_bound(
+                    py,
+                    e.as_bytes(),
+                    e.utf8_error(),
+                )?;
+                Err(PyErr::from_value_bound(err.into_any()))
+            }
+        }
+    }
+
+    /// Decodes a CSR token layout, as returned by `encode_batch`, into a list of bytes.
+    ///
+    /// The sequences are decoded on `num_threads` threads with the GIL released.
+    #[pyo3(name = "decode_batch_bytes")]
+    fn py_decode_batch_bytes(
+        &self,
+        py: Python,
+        tokens: PyBuffer<Rank>,
+        offsets: PyBuffer<u64>,
+        num_threads: usize,
+    ) -> PyResult<Py<PyList>> {
+        let tokens = tokens.to_vec(py)?;
+        let offsets = offsets.to_vec(py)?;
+        if offsets.first().map_or(false, |&offset| offset != 0)
+            || offsets.windows(2).any(|w| w[0] > w[1])
+            || offsets
+                .last()
+                .map_or(false, |&offset| offset != tokens.len() as u64)
+        {
+            return Err(exceptions::PyValueError::new_err(
+                "Offsets must be non-decreasing, starting at 0 and ending at the number of tokens",
+            ));
+        }
+        let decoded = py.allow_threads(|| {
+            let sequences: Vec<&[Rank]> = offsets
+                .windows(2)
+                .map(|w| &tokens[w[0] as usize..w[1] as usize])
+                .collect();
+            self.decode_batch_bytes(&sequences, num_threads)
+        });
+        match decoded {
+            Ok(decoded) => Ok(PyList::new_bound(
+                py,
+                decoded.iter().map(|bytes| PyBytes::new_bound(py, bytes)),
+            )
+            .into()),
+            Err(e) => Err(exceptions::PyKeyError::new_err(format!("{}", e))),
+        }
+    }
+
+    /// Decodes tokens into a writable, C-contiguous byte buffer and returns the number of
+    /// bytes written. Raises `ValueError` if the buffer is too small, leaving it untouched.
+    #[pyo3(name = "decode_bytes_into")]
+    fn py_decode_bytes_into(
+        &self,
+        py: Python,
+        tokens: Vec<Rank>,
+        out: PyBuffer<u8>,
+    ) -> PyResult<usize> {
+        if out.readonly() || !out.is_c_contiguous() {
+            return Err(exceptions::PyValueError::new_err(
+                "Output buffer must be writable and C-contiguous",
+            ));
+        }
+        // Safe while we hold the GIL and the buffer export: the buffer can't be resized or freed
+        let out_slice =
+            unsafe { std::slice::from_raw_parts_mut(out.buf_ptr() as *mut u8, out.len_bytes()) };
+        let len = self
+            .decode_bytes_into(&tokens, out_slice)
+            .map_err(|e| exceptions::PyKeyError::new_err(format!("{}", e)))?;
+        if len > out.len_bytes() {
+            return Err(exceptions::PyValueError::new_err(format!(
+                "Output buffer too small: need {} bytes, got {}",
+                len,
+                out.len_bytes()
+            )));
+        }
+        Ok(len)
+    }
+
     fn decode_single_token_bytes(&self, py: Python, token: Rank) -> PyResult<Py<PyBytes>> {
-        if let Some(bytes) = self.decoder.get(&token) {
+        if let Some(bytes) = self.vocab.token_bytes(token) {
             return Ok(PyBytes::new_bound(py, bytes).into());
         }
         if let Some(bytes) = self.special_tokens_decoder.get(&token) {
@@ -175,12 +428,201 @@ impl CoreBPE {
     // Miscellaneous
     // ====================
 
+    /// Hit/miss counters of the piece cache as a dict, or None if it is disabled.
+    #[pyo3(name = "piece_cache_stats")]
+    fn py_piece_cache_stats(&self, py: Python) -> PyResult<Option<Py<PyDict>>> {
+        let stats = match self.piece_cache_stats() {
+            Some(stats) => stats,
+            None => return Ok(None),
+        };
+        let dict = PyDict::new_bound(py);
+        dict.set_item("hits", stats.hits)?;
+        dict.set_item("misses", stats.misses)?;
+        dict.set_item("skipped", stats.skipped)?;
+        dict.set_item("entries", stats.entries)?;
+        dict.set_item("capacity", stats.capacity)?;
+        Ok(Some(dict.into()))
+    }
+
     fn token_byte_values(&self, py: Python) -> Vec<Py<PyBytes>> {
-        self.sorted_token_bytes
-            .iter()
-            .map(|x| PyBytes::new_bound(py, x).into())
+        self.vocab
+            .sorted_ranks()
+            .map(|rank| PyBytes::new_bound(py, self.vocab.token_bytes(rank).unwrap()).into())
             .collect()
     }
+
+    /// Writes the vocabulary, pattern and special tokens to a file for `from_snapshot`, with a
+    /// `fingerprint` of the source they were built from.
+    #[pyo3(name = "save_snapshot", signature = (path, fingerprint = ""))]
+    fn py_save_snapshot(&self, py: Python, path: PathBuf, fingerprint: &str) -> PyResult<()> {
+        py.allow_threads(|| self.save_snapshot(path, fingerprint))
+            .map_err(snapshot_error)
+    }
+
+    #[getter]
+    #[pyo3(name = "pattern")]
+    fn py_pattern(&self) -> &str {
+        self.pattern()
+    }
+
+    #[getter]
+    fn special_tokens_encoder(&self) -> HashMap<String, Rank> {
+        self.special_tokens_encoder.clone()
+    }
+
+    #[getter]
+    #[pyo3(name = "max_token_value")]
+    fn py_max_token_value(&self) -> Option<Rank> {
+        self.max_token_value()
+    }
+}
+
+fn snapshot_error(e: SnapshotError) -> PyErr {
+    match e {
+        SnapshotError::Io(e) => e.into(),
+        SnapshotError::Format(_) => exceptions::PyValueError::new_err(e.to_string()),
+    }
+}
+
+/// Number of complete characters in the first `byte_offset` bytes of `text`.
+fn char_count_before(text: &str, byte_offset: usize) -> usize {
+    text.char_indices()
+        .take_while(|(i, c)| i + c.len_utf8() <= byte_offset)
+        .count()
+}
+
+/// `(token_start, token_end, char_start, char_end)` of a chunk.
+type ChunkRanges = (usize, usize, usize, usize);
+
+fn check_chunk_sizes(max_tokens: usize, overlap: usize) -> PyResult<()> {
+    if overlap >= max_tokens {
+        return Err(PyErr::new::<exceptions::PyValueError, _>(
+            "overlap must be less than max_tokens",
+        ));
+    }
+    Ok(())
+}
+
+/// Converts the byte ranges of `chunks` to char ranges of `text`, in one pass over `text` for
+/// the starts and one for the ends, which both increase from chunk to chunk.
+fn chunk_char_ranges(text: &str, chunks: &[TokenChunk]) -> Vec<ChunkRanges> {
+    let starts = char_offsets(text, chunks.iter().map(|chunk| chunk.bytes.start));
+    let ends = char_offsets(text, chunks.iter().map(|chunk| chunk.bytes.end));
+    chunks
+        .iter()
+        .zip(starts.into_iter().zip(ends))
+        .map(|(chunk, (start, end))| (chunk.tokens.start, chunk.tokens.end, start, end))
+        .collect()
+}
+
+/// Char offsets in `text` of increasing byte offsets on char boundaries.
+fn char_offsets(text: &str, byte_offsets: impl Iterator<Item = usize>) -> Vec<usize> {
+    let mut chars = text.char_indices().peekable();
+    let mut count = 0;
+    byte_offsets
+        .map(|offset| {
+            while chars.next_if(|&(i, _)| i < offset).is_some() {
+                count += 1;
+            }
+            count
+        })
+        .collect()
+}
+
+#[pyclass(name = "StreamingEncoder")]
+struct PyStreamingEncoder {
+    core_bpe: Py<CoreBPE>,
+    encoder: StreamingEncoder,
+}
+
+#[pymethods]
+impl PyStreamingEncoder {
+    /// Adds a chunk of text and returns the tokens that can no longer change.
+    fn push(&mut self, py: Python, chunk: &str) -> Vec<Rank> {
+        let core_bpe = self.core_bpe.borrow(py);
+        let core_bpe: &CoreBPE = &core_bpe;
+        let encoder = &mut self.encoder;
+        py.allow_threads(|| encoder.push(core_bpe, chunk))
+    }
+
+    /// Returns the tokens of the text that is still held back.
+    fn finish(&mut self, py: Python) -> Vec<Rank> {
+        let core_bpe = self.core_bpe.borrow(py);
+        let core_bpe: &CoreBPE = &core_bpe;
+        let encoder = &mut self.encoder;
+        py.allow_threads(|| encoder.finish(core_bpe))
+    }
+
+    /// Number of characters of text that the returned tokens cover so far.
+    #[getter]
+    fn committed_chars(&self) -> usize {
+        self.encoder.committed_chars()
+    }
+}
+
+/// Element types that can be exposed through the buffer protocol.
+trait BufferElement {
+    /// `struct` module format character of the element type.
+    const FORMAT: &'static str;
+}
+
+impl BufferElement for Rank {
+    const FORMAT: &'static str = "I";
+}
+
+impl BufferElement for u64 {
+    const FORMAT: &'static str = "Q";
+}
+
+// Based on https://github.com/PyO3/pyo3/blob/v0.22.2/tests/test_buffer_protocol.rs#L25
+unsafe fn fill_buffer_view<T: BufferElement>(
+    obj: Bound<'_, PyAny>,
+    data: &[T],
+    view: *mut pyo3::ffi::Py_buffer,
+    flags: std::os::raw::c_int,
+) -> PyResult<()> {
+    if view.is_null() {
+        return Err(pyo3::exceptions::PyBufferError::new_err("View is null"));
+    }
+    if (flags & pyo3::ffi::PyBUF_WRITABLE) == pyo3::ffi::PyBUF_WRITABLE {
+        return Err(pyo3::exceptions::PyBufferError::new_err(
+            "Object is not writable",
+        ));
+    }
+
+    (*view).obj = obj.into_ptr();
+
+    (*view).buf = data.as_ptr() as *mut std::os::raw::c_void;
+    (*view).len = std::mem::size_of_val(data) as isize;
+    (*view).readonly = 1;
+    (*view).itemsize = std::mem::size_of::<T>() as isize;
+    (*view).format = if (flags & pyo3::ffi::PyBUF_FORMAT) == pyo3::ffi::PyBUF_FORMAT {
+        let msg = std::ffi::CString::new(T::FORMAT).unwrap();
+        msg.into_raw()
+    } else {
+        std::ptr::null_mut()
+    };
+    (*view).ndim = 1;
+    (*view).shape = if (flags & pyo3::ffi::PyBUF_ND) == pyo3::ffi::PyBUF_ND {
+        &mut (*view).len
+    } else {
+        std::ptr::null_mut()
+    };
+    (*view).strides = if (flags & pyo3::ffi::PyBUF_STRIDES) == pyo3::ffi::PyBUF_STRIDES {
+        &mut (*view).itemsize
+    } else {
+        std::ptr::null_mut()
+    };
+    (*view).suboffsets = std::ptr::null_mut();
+    (*view).internal = std::ptr::null_mut();
+
+    Ok(())
+}
+
+unsafe fn release_buffer_view(view: *mut pyo3::ffi::Py_buffer) {
+    if !(*view).format.is_null() {
+        std::mem::drop(std::ffi::CString::from_raw((*view).format));
+    }
 }
 
 #[pyclass]
@@ -190,58 +632,46 @@ struct TiktokenBuffer {
 
 #[pymethods]
 impl TiktokenBuffer {
-    // Based on https://github.com/PyO3/pyo3/blob/v0.22.2/tests/test_buffer_protocol.rs#L25
     unsafe fn __getbuffer__(
         slf: Bound<'_, Self>,
         view: *mut pyo3::ffi::Py_buffer,
         flags: std::os::raw::c_int,
     ) -> PyResult<()> {
-        if view.is_null() {
-            return Err(pyo3::exceptions::PyBufferError::new_err("View is null"));
-        }
-        if (flags & pyo3::ffi::PyBUF_WRITABLE) == pyo3::ffi::PyBUF_WRITABLE {
-            return Err(pyo3::exceptions::PyBufferError::new_err(
-                "Object is not writable",
-            ));
-        }
+        // The tokens are never modified, so they stay valid for as long as the view holds `slf`
+        let this = slf.borrow();
+        fill_buffer_view(slf.clone().into_any(), &this.tokens, view, flags)
+    }
 
-        (*view).obj = slf.clone().into_any().into_ptr();
-
-        let data = &slf.borrow().tokens;
-        (*view).buf = data.as_ptr() as *mut std::os::raw::c_void;
-        (*view).len = (data.len() * std::mem::size_of::<Rank>()) as isize;
-        (*view).readonly = 1;
-        (*view).itemsize = std::mem::size_of::<Rank>() as isize;
-        (*view).format = if (flags & pyo3::ffi::PyBUF_FORMAT) == pyo3::ffi::PyBUF_FORMAT {
-            let msg = std::ffi::CString::new("I").unwrap();
-            msg.into_raw()
-        } else {
-            std::ptr::null_mut()
-        };
-        (*view).ndim = 1;
-        (*view).shape = if (flags & pyo3::ffi::PyBUF_ND) == pyo3::ffi::PyBUF_ND {
-            &mut (*view).len
-        } else {
-            std::ptr::null_mut()
-        };
-        (*view).strides = if (flags & pyo3::ffi::PyBUF_STRIDES) == pyo3::ffi::PyBUF_STRIDES {
-            &mut (*view).itemsize
-        } else {
-            std::ptr::null_mut()
-        };
-        (*view).suboffsets = std::ptr::null_mut();
-        (*view).internal = std::ptr::null_mut();
+    unsafe fn __releasebuffer__(&self, view: *mut pyo3::ffi::Py_buffer) {
+        release_buffer_view(view)
+    }
+}
 
-        Ok(())
+/// Offsets of a CSR token layout, as returned by `CoreBPE.encode_batch`.
+#[pyclass]
+struct TiktokenOffsetsBuffer {
+    offsets: Vec<u64>,
+}
+
+#[pymethods]
+impl TiktokenOffsetsBuffer {
+    unsafe fn __getbuffer__(
+        slf: Bound<'_, Self>,
+        view: *mut pyo3::ffi::Py_buffer,
+        flags: std::os::raw::c_int,
+    ) -> PyResult<()> {
+        let this = slf.borrow();
+        fill_buffer_view(slf.clone().into_any(), &this.offsets, view, flags)
     }
 
     unsafe fn __releasebuffer__(&self, view: *mut pyo3::ffi::Py_buffer) {
-        std::mem::drop(std::ffi::CString::from_raw((*view).format));
+        release_buffer_view(view)
     }
 }
 
 #[pymodule]
 fn _tiktoken(_py: Python, m: &Bound<PyModule>) -> PyResult<()> {
     m.add_class::<CoreBPE>()?;
+    m.add_class::<PyStreamingEncoder>()?;
     Ok(())
 }
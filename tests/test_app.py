@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+import tiktoken
+
+pytest.importorskip("flask")
+pytest.importorskip("sklearn")
+
+
+@pytest.fixture(scope="module")
+def app_module():
+    # Don't load every encoding in the background on import
+    os.environ.setdefault("WARMUP_ENCODINGS", "")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    try:
+        import app
+    finally:
+        sys.path.pop(0)
+    return app
+
+
+@pytest.mark.parametrize("encoding_name", ["r50k_base", "cl100k_base", "o200k_base"])
+@pytest.mark.parametrize(
+    "text", ["x \ny", "x\n\ny", "x\r\n\r\ny", "x \t\ny z", "ab12 cd\nef", "a\n/b"]
+)
+def test_stable_split_point(app_module, encoding_name, text):
+    enc = tiktoken.get_encoding(encoding_name)
+    end = len(text)
+    while (split := app_module._stable_split_point(text[:end])) is not None:
+        assert enc.encode(text[:split]) + enc.encode(text[split:]) == enc.encode(text)
+        end = split
+
+
+def test_result_cache_peek(app_module):
+    cache = app_module._ResultCache(max_bytes=1000, ttl=60)
+    assert cache.peek("key") is None
+    cache.put("key", "value", 10)
+    assert cache.peek("key") == "value"
+    assert cache.stats()["hits"] == cache.stats()["misses"] == 0
@@ -215,6 +215,22 @@ def test_special_token():
     assert fim in tokens
 
 
+def test_special_token_lookalikes():
+    enc = tiktoken.get_encoding("cl100k_base")
+    eot = enc.eot_token
+
+    text = "<|endoftext <|fim_prefix|><|endoftext|> <|<|endoftext|>|> <|endoftex|>" * 100
+    # The core skips special tokens that aren't allowed, Encoding.encode rejects them
+    tokens = enc._core_bpe.encode(text, {"<|endoftext|>"})
+    assert tokens.count(eot) == 200
+    assert enc.decode(tokens) == text
+    pieces = text.split("<|endoftext|>")
+    expected = enc.encode_ordinary(pieces[0])
+    for piece in pieces[1:]:
+        expected += [eot] + enc.encode_ordinary(piece)
+    assert tokens == expected
+
+
 @pytest.mark.parametrize("make_enc", ENCODING_FACTORIES)
 @hypothesis.given(text=st.text())
 @hypothesis.settings(deadline=None, max_examples=MAX_EXAMPLES)
@@ -223,6 +239,147 @@ def test_hyp_special_ordinary(make_enc, text: str):
     assert enc.encode_ordinary(text) == enc.encode(text, disallowed_special=())
 
 
+# ====================
+# Token counting
+# ====================
+
+
+@pytest.mark.parametrize("make_enc", ENCODING_FACTORIES)
+def test_count_tokens(make_enc: Callable[[], tiktoken.Encoding]):
+    enc = make_enc()
+    core_bpe = enc._core_bpe
+    for text in ["", "hello world", "hello <|endoftext|>", "0" * 1000, "  \n\n\t x\u00e9"]:
+        assert core_bpe.count_ordinary(text) == len(enc.encode_ordinary(text))
+        assert core_bpe.count_tokens(text, set()) == len(enc.encode(text, disallowed_special=()))
+        assert core_bpe.count_tokens(text, enc.special_tokens_set) == len(
+            enc.encode(text, allowed_special="all")
+        )
+
+
+@pytest.mark.parametrize("make_enc", ENCODING_FACTORIES)
+@hypothesis.given(
+    text=st.text(alphabet=st.characters(blacklist_categories=["Cs"])),
+    max_tokens=st.integers(min_value=0, max_value=50),
+)
+@hypothesis.settings(deadline=None, max_examples=MAX_EXAMPLES)
+def test_hyp_encode_with_limit(
+    make_enc: Callable[[], tiktoken.Encoding], text: str, max_tokens: int
+):
+    enc = make_enc()
+    tokens = enc.encode(text, allowed_special="all")
+    limited, char_offset = enc._core_bpe.encode_with_limit(
+        text, enc.special_tokens_set, max_tokens
+    )
+    assert limited == tokens[:max_tokens]
+    assert enc.decode_bytes(limited).decode("utf-8", errors="ignore") == text[:char_offset]
+
+    limited, char_offset = enc._core_bpe.encode_ordinary_with_limit(text, max_tokens)
+    assert limited == enc.encode_ordinary(text)[:max_tokens]
+    assert enc.decode_bytes(limited).decode("utf-8", errors="ignore") == text[:char_offset]
+
+
+@pytest.mark.parametrize("make_enc", ENCODING_FACTORIES)
+@hypothesis.given(
+    text=st.text(alphabet=st.characters(blacklist_categories=["Cs"])),
+    max_tokens=st.integers(min_value=1, max_value=20),
+    overlap=st.integers(min_value=0, max_value=19),
+)
+@hypothesis.settings(deadline=None, max_examples=MAX_EXAMPLES)
+def test_hyp_chunk_by_tokens(
+    make_enc: Callable[[], tiktoken.Encoding], text: str, max_tokens: int, overlap: int
+):
+    enc = make_enc()
+    overlap = min(overlap, max_tokens - 1)
+    tokens, chunks = enc._core_bpe.chunk_by_tokens(
+        text, enc.special_tokens_set, max_tokens, overlap
+    )
+    assert tokens == enc.encode(text, allowed_special="all")
+    starts = range(0, max(len(tokens) - overlap, 1), max_tokens - overlap) if tokens else []
+    assert [chunk[:2] for chunk in chunks] == [
+        (start, min(start + max_tokens, len(tokens))) for start in starts
+    ]
+    for token_start, token_end, char_start, char_end in chunks:
+        chunk_text = enc.decode(tokens[token_start:token_end], errors="ignore")
+        assert chunk_text in text[char_start:char_end]
+
+    assert enc._core_bpe.chunk_batch([text, ""], set(), max_tokens, overlap, 2) == [
+        enc._core_bpe.chunk_by_tokens(text, set(), max_tokens, overlap),
+        ([], []),
+    ]
+
+
+@pytest.mark.parametrize("make_enc", ENCODING_FACTORIES)
+@hypothesis.given(text=st.text(alphabet=st.characters(blacklist_categories=["Cs"])))
+@hypothesis.settings(deadline=None, max_examples=MAX_EXAMPLES)
+def test_hyp_count_tokens(make_enc: Callable[[], tiktoken.Encoding], text: str):
+    enc = make_enc()
+    assert enc._core_bpe.count_ordinary(text) == len(enc.encode_ordinary(text))
+    assert enc._core_bpe.count_tokens(text, enc.special_tokens_set) == len(
+        enc.encode(text, allowed_special="all")
+    )
+
+
+def test_piece_cache():
+    enc = tiktoken.get_encoding("cl100k_base")
+    assert enc._core_bpe.piece_cache_stats() is None
+
+    core_bpe = type(enc._core_bpe)(
+        enc._mergeable_ranks, enc._special_tokens, enc._pat_str, piece_cache_size=1000
+    )
+    text = "deadbeefcafe0123 = lookup(deadbeefcafe0123)\n" * 10
+    for _ in range(3):
+        assert core_bpe.encode_ordinary(text) == enc.encode_ordinary(text)
+    stats = core_bpe.piece_cache_stats()
+    assert stats["misses"] > 0
+    assert stats["hits"] > stats["misses"]
+    assert 0 < stats["entries"] <= stats["capacity"]
+
+
+@pytest.mark.parametrize("make_enc", ENCODING_FACTORIES)
+@hypothesis.given(
+    chunks=st.lists(st.text(alphabet=st.characters(blacklist_categories=["Cs"]))),
+    allow_special=st.booleans(),
+)
+@hypothesis.settings(deadline=None, max_examples=MAX_EXAMPLES)
+def test_hyp_streaming_encoder(
+    make_enc: Callable[[], tiktoken.Encoding], chunks: list[str], allow_special: bool
+):
+    enc = make_enc()
+    allowed_special = enc.special_tokens_set if allow_special else set()
+    chunks = [c + "<|endoftext|>" if i % 3 == 1 else c for i, c in enumerate(chunks)]
+    text = "".join(chunks)
+
+    streaming_encoder = enc._core_bpe.streaming_encoder(allowed_special)
+    tokens = []
+    for chunk in chunks:
+        tokens += streaming_encoder.push(chunk)
+        assert enc.decode(tokens) == text[: streaming_encoder.committed_chars]
+    tokens += streaming_encoder.finish()
+    assert tokens == enc._core_bpe.encode(text, allowed_special)
+
+
+def test_streaming_encoder_emits_early():
+    enc = tiktoken.get_encoding("o200k_base")
+    streaming_encoder = enc._core_bpe.streaming_encoder(set())
+    assert streaming_encoder.push("he'") == []
+    tokens = streaming_encoder.push("s here")
+    assert enc.decode(tokens) == "he's"
+    tokens += streaming_encoder.finish()
+    assert tokens == enc.encode("he's here")
+
+
+@pytest.mark.parametrize("text", ["x \ny", "x\n\ny", "x\r\n\r\ny", "x \t\ny z"])
+def test_streaming_encoder_whitespace_before_line_break(text):
+    # At the end of a chunk, the r50k pattern makes whitespace and a line break one piece
+    enc = tiktoken.get_encoding("r50k_base")
+    for split in range(1, len(text)):
+        streaming_encoder = enc._core_bpe.streaming_encoder(set())
+        tokens = streaming_encoder.push(text[:split])
+        tokens += streaming_encoder.push(text[split:])
+        tokens += streaming_encoder.finish()
+        assert tokens == enc.encode(text)
+
+
 # ====================
 # Batch encoding
 # ====================
@@ -244,6 +401,47 @@ def test_batch_encode(make_enc: Callable[[], tiktoken.Encoding]):
     ]
 
 
+@pytest.mark.parametrize("make_enc", ENCODING_FACTORIES)
+def test_core_batch_encode(make_enc: Callable[[], tiktoken.Encoding]):
+    enc = make_enc()
+    texts = ["hello world", "", "goodbye <|endoftext|> world", "0" * 1000] * 10
+
+    for num_threads in [1, 4]:
+        tokens, offsets = enc._core_bpe.encode_batch(texts, enc.special_tokens_set, num_threads)
+        tokens, offsets = memoryview(tokens).tolist(), memoryview(offsets).tolist()
+        assert len(offsets) == len(texts) + 1
+        assert [tokens[start:end] for start, end in zip(offsets, offsets[1:])] == [
+            enc.encode(text, allowed_special="all") for text in texts
+        ]
+
+
+@pytest.mark.parametrize("make_enc", ENCODING_FACTORIES)
+def test_core_batch_decode(make_enc: Callable[[], tiktoken.Encoding]):
+    enc = make_enc()
+    texts = ["hello world", "", "goodbye <|endoftext|> world", "\u00e9" * 100] * 10
+
+    tokens, offsets = enc._core_bpe.encode_batch(texts, enc.special_tokens_set, 4)
+    decoded = enc._core_bpe.decode_batch_bytes(tokens, offsets, 4)
+    assert decoded == [text.encode("utf-8") for text in texts]
+
+    with pytest.raises(ValueError):
+        enc._core_bpe.decode_batch_bytes(tokens, memoryview(offsets)[:-1], 4)
+
+
+def test_core_decode_bytes_into():
+    enc = tiktoken.get_encoding("cl100k_base")
+    tokens = enc.encode("hello world")
+
+    out = bytearray(16)
+    assert enc._core_bpe.decode_bytes_into(tokens, out) == 11
+    assert out[:11] == b"hello world"
+
+    small = bytearray(4)
+    with pytest.raises(ValueError):
+        enc._core_bpe.decode_bytes_into(tokens, small)
+    assert small == bytearray(4)
+
+
 @pytest.mark.parametrize("make_enc", ENCODING_FACTORIES)
 @hypothesis.given(batch=st.lists(st.text()))
 @hypothesis.settings(deadline=None)
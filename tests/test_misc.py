@@ -26,3 +26,14 @@ import sys
 assert "blobfile" not in sys.modules
 """
     subprocess.check_call([sys.executable, "-c", prog])
+
+
+def test_shared_mergeable_ranks():
+    from tiktoken_ext import openai_public
+
+    # Same file, and the same ranks in two formats
+    p50k_base = openai_public.p50k_base()
+    assert p50k_base["mergeable_ranks"] is openai_public.p50k_edit()["mergeable_ranks"]
+    gpt2 = openai_public.gpt2()
+    assert gpt2["mergeable_ranks"] is openai_public.r50k_base()["mergeable_ranks"]
+    assert gpt2["mergeable_ranks"] is not openai_public.cl100k_base()["mergeable_ranks"]
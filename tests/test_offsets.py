@@ -44,6 +44,10 @@ def test_hyp_offsets(make_enc: Callable[[], tiktoken.Encoding], data):
     # We could potentially drop this, see the TODO in decode_with_offsets
     tokens = enc.encode(enc.decode(tokens, errors="ignore"), allowed_special="all")
     assert enc.decode_with_offsets(tokens)[1] == _token_offsets_reference(enc, tokens)
+    assert enc._core_bpe.decode_with_offsets(tokens) == (
+        enc.decode(tokens, errors="strict"),
+        _token_offsets_reference(enc, tokens),
+    )
 
 
 def test_basic_offsets():
@@ -77,3 +81,18 @@ def test_basic_offsets():
     p, o = enc.decode_with_offsets(enc.encode(prompt))
     assert p == prompt
     assert o == [0, 1]
+
+
+def test_core_decode_with_offsets():
+    enc = tiktoken.get_encoding("cl100k_base")
+
+    for prompt in ["", "hello world<|endoftext|> green cow", "நடிகர் சூர்யா", " Ġ除" * 1000]:
+        tokens = enc.encode(prompt, allowed_special="all")
+        assert enc._core_bpe.decode_with_offsets(tokens) == enc.decode_with_offsets(tokens)
+
+    # The second token starts in the middle of the first character, see test_basic_offsets
+    tokens = enc.encode("நடிகர்")
+    with pytest.raises(UnicodeDecodeError):
+        enc._core_bpe.decode_with_offsets(tokens[:1])
+    with pytest.raises(KeyError):
+        enc._core_bpe.decode_with_offsets([enc.n_vocab + 1])
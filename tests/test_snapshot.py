@@ -0,0 +1,38 @@
+import pytest
+
+import tiktoken
+
+
+def test_snapshot_round_trip(tmp_path):
+    enc = tiktoken.get_encoding("cl100k_base")
+    path = tmp_path / "cl100k_base.tkbpe"
+    enc._core_bpe.save_snapshot(str(path))
+
+    core_bpe = type(enc._core_bpe).from_snapshot(str(path))
+    assert core_bpe.pattern == enc._pat_str
+    assert core_bpe.special_tokens_encoder == enc._special_tokens
+    assert core_bpe.max_token_value == enc.max_token_value
+
+    text = "hello world <|endoftext|> 你好 🙂" * 10
+    tokens = enc.encode(text, allowed_special="all")
+    assert core_bpe.encode(text, set(enc.special_tokens_set)) == tokens
+    assert core_bpe.decode_bytes(tokens) == text.encode()
+    assert core_bpe.token_byte_values() == enc._core_bpe.token_byte_values()
+
+
+def test_snapshot_errors(tmp_path):
+    core_bpe_type = type(tiktoken.get_encoding("r50k_base")._core_bpe)
+
+    with pytest.raises(OSError):
+        core_bpe_type.from_snapshot(str(tmp_path / "missing.tkbpe"))
+
+    path = tmp_path / "bad.tkbpe"
+    path.write_bytes(b"not a snapshot" * 100)
+    with pytest.raises(ValueError):
+        core_bpe_type.from_snapshot(str(path))
+
+    # Saved from another source than the caller expects
+    tiktoken.get_encoding("r50k_base")._core_bpe.save_snapshot(str(path), fingerprint="v1")
+    core_bpe_type.from_snapshot(str(path), fingerprint="v1")
+    with pytest.raises(ValueError):
+        core_bpe_type.from_snapshot(str(path), fingerprint="v2")
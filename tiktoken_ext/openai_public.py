@@ -1,4 +1,9 @@
-from tiktoken.load import data_gym_to_mergeable_bpe_ranks, load_tiktoken_bpe
+import base64
+import hashlib
+import threading
+import weakref
+
+from tiktoken.load import data_gym_to_mergeable_bpe_ranks, read_file_cached
 
 ENDOFTEXT = "<|endoftext|>"
 FIM_PREFIX = "<|fim_prefix|>"
@@ -13,13 +18,71 @@ r50k_pat_str = (
     r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}++| ?\p{N}++| ?[^\s\p{L}\p{N}]++|\s++$|\s+(?!\S)|\s"""
 )
 
+# Parsed mergeable ranks, keyed by the sha256 of the files they were parsed from. Encodings with
+# the same vocabulary get the same dict: p50k_base and p50k_edit read the same file, and gpt2 and
+# r50k_base have the same ranks in two formats. So the ranks are parsed and held in memory once,
+# and must not be modified by the caller. The store only holds weak references, so the ranks are
+# freed with the last encoding that uses them.
+class _SharedRanks(dict):
+    """A dict of mergeable ranks, which unlike a plain dict can be weakly referenced."""
+
+
+_ranks_store: "weakref.WeakValueDictionary[str, _SharedRanks]" = weakref.WeakValueDictionary()
+_ranks_locks: dict[str, threading.Lock] = {}
+_ranks_store_lock = threading.Lock()
+
+
+def _shared_ranks(content_hash, parse):
+    """Returns the ranks parsed from files with this content hash, calling parse() only once."""
+    with _ranks_store_lock:
+        lock = _ranks_locks.setdefault(content_hash, threading.Lock())
+    # One lock per content hash, so that different vocabularies are still loaded in parallel
+    with lock:
+        mergeable_ranks = _ranks_store.get(content_hash)
+        if mergeable_ranks is None:
+            mergeable_ranks = _SharedRanks(parse())
+            with _ranks_store_lock:
+                # The same ranks may be stored already, parsed from files in another format
+                for other in list(_ranks_store.values()):
+                    if len(other) == len(mergeable_ranks) and other == mergeable_ranks:
+                        mergeable_ranks = other
+                        break
+                _ranks_store[content_hash] = mergeable_ranks
+    return mergeable_ranks
+
+
+def _parse_tiktoken_bpe(contents: bytes, tiktoken_bpe_file: str) -> dict[bytes, int]:
+    # Same as load_tiktoken_bpe, but parses contents that were already read
+    ret = {}
+    for line in contents.splitlines():
+        if not line:
+            continue
+        try:
+            token, rank = line.split()
+            ret[base64.b64decode(token)] = int(rank)
+        except Exception as e:
+            raise ValueError(f"Error parsing line {line!r} in {tiktoken_bpe_file}") from e
+    return ret
+
+
+def _load_tiktoken_bpe_shared(tiktoken_bpe_file: str) -> dict[bytes, int]:
+    # The file is read once, both to key the store and to be parsed on a miss
+    contents = read_file_cached(tiktoken_bpe_file)
+    content_hash = hashlib.sha256(contents).hexdigest()
+    return _shared_ranks(content_hash, lambda: _parse_tiktoken_bpe(contents, tiktoken_bpe_file))
+
 
 def gpt2():
-    mergeable_ranks = data_gym_to_mergeable_bpe_ranks(
-        vocab_bpe_file="https://openaipublic.blob.core.windows.net/gpt-2/encodings/main/vocab.bpe",
-        encoder_json_file="https://openaipublic.blob.core.windows.net/gpt-2/encodings/main/encoder.json",
-        vocab_bpe_hash="1ce1664773c50f3e0cc8842619a93edc4624525b728b188a9e0be33b7726adc5",
-        encoder_json_hash="196139668be63f3b5d6574427317ae82f612a97c5d1cdaf36ed2256dbf636783",
+    vocab_bpe_hash = "1ce1664773c50f3e0cc8842619a93edc4624525b728b188a9e0be33b7726adc5"
+    encoder_json_hash = "196139668be63f3b5d6574427317ae82f612a97c5d1cdaf36ed2256dbf636783"
+    mergeable_ranks = _shared_ranks(
+        f"{vocab_bpe_hash}+{encoder_json_hash}",
+        lambda: data_gym_to_mergeable_bpe_ranks(
+            vocab_bpe_file="https://openaipublic.blob.core.windows.net/gpt-2/encodings/main/vocab.bpe",
+            encoder_json_file="https://openaipublic.blob.core.windows.net/gpt-2/encodings/main/encoder.json",
+            vocab_bpe_hash=vocab_bpe_hash,
+            encoder_json_hash=encoder_json_hash,
+        ),
     )
     return {
         "name": "gpt2",
@@ -31,7 +94,7 @@ def gpt2():
 
 
 def r50k_base():
-    mergeable_ranks = load_tiktoken_bpe(
+    mergeable_ranks = _load_tiktoken_bpe_shared(
         "https://openaipublic.blob.core.windows.net/encodings/r50k_base.tiktoken",
     )
     return {
@@ -44,7 +107,7 @@ def r50k_base():
 
 
 def p50k_base():
-    mergeable_ranks = load_tiktoken_bpe(
+    mergeable_ranks = _load_tiktoken_bpe_shared(
         "https://openaipublic.blob.core.windows.net/encodings/p50k_base.tiktoken",
     )
     return {
@@ -57,7 +120,7 @@ def p50k_base():
 
 
 def p50k_edit():
-    mergeable_ranks = load_tiktoken_bpe(
+    mergeable_ranks = _load_tiktoken_bpe_shared(
         "https://openaipublic.blob.core.windows.net/encodings/p50k_base.tiktoken",
     )
     special_tokens = {ENDOFTEXT: 50256, FIM_PREFIX: 50281, FIM_MIDDLE: 50282, FIM_SUFFIX: 50283}
@@ -70,7 +133,7 @@ def p50k_edit():
 
 
 def cl100k_base():
-    mergeable_ranks = load_tiktoken_bpe(
+    mergeable_ranks = _load_tiktoken_bpe_shared(
         "https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken",
     )
     special_tokens = {
@@ -89,7 +152,7 @@ def cl100k_base():
 
 
 def o200k_base():
-    mergeable_ranks = load_tiktoken_bpe(
+    mergeable_ranks = _load_tiktoken_bpe_shared(
         "https://openaipublic.blob.core.windows.net/encodings/o200k_base.tiktoken",
     )
     special_tokens = {ENDOFTEXT: 199999, ENDOFPROMPT: 200018}